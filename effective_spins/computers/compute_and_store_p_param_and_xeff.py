@@ -0,0 +1,93 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+from tqdm.auto import tqdm
+
+from effective_spins import probability_cacher
+from effective_spins.computers.merge_shards import add_shard_arguments, shard_fname, shard_items
+from effective_spins.cupy_utils import to_numpy, xp
+from effective_spins.priors_conditional_on_xeff import (
+    MC_SAMPLES,
+    get_traditional_prior,
+    p_param_and_xeff_grid,
+)
+
+OUTDIR = "p_param_and_xeff"
+PARAM_RANGES = dict(a1=(0, 1), a2=(0, 1), q=(0, 1), cos2=(-1, 1))
+
+
+def get_grid(param_key, num_params, num_xeffs):
+    params = np.linspace(*PARAM_RANGES[param_key], num_params)
+    xeffs = np.linspace(-1, 1, num_xeffs)
+    return params, xeffs
+
+
+def compute_and_store_p_param_and_xeff(
+        param_key, fname, params, xeffs, chunk_size=10, method="mc", prior=None, chunks=None
+):
+    """
+    Compute p(param_key and xeff) on the (params, xeffs) grid, `chunk_size`
+    xeffs at a time, appending each chunk to `fname` as it finishes.
+    Chunks already recorded in `fname` are skipped, so an interrupted run
+    resumes where it stopped. `chunks` restricts the run to those chunk ids.
+    """
+    prior = get_traditional_prior() if prior is None else prior
+    # sorted, so every chunk is a disjoint xeff range that `remove_probabilities` can clear
+    xeffs = np.sort(np.asarray(xeffs, dtype=float))
+    key = get_run_key(prior, params, xeffs, chunk_size, method)
+    done = set(probability_cacher.completed_chunks(fname, key))
+    xeff_chunks = split_into_chunks(xeffs, chunk_size)
+    chunks = range(len(xeff_chunks)) if chunks is None else chunks
+    todo = [c for c in chunks if c not in done]
+    for c in tqdm(todo, desc=f"p({param_key} and xeff) chunks"):
+        chunk_xeffs = xeff_chunks[c]
+        # rows of a chunk that was being written when the last run stopped
+        probability_cacher.remove_probabilities(fname, "xeff", float(np.min(chunk_xeffs)), float(np.max(chunk_xeffs)))
+        p = p_param_and_xeff_grid(params, chunk_xeffs, prior, param_key, method=method)
+        param_grid, xeff_grid = np.meshgrid(params, chunk_xeffs, indexing="ij")
+        df = pd.DataFrame({
+            param_key: param_grid.ravel(),
+            "xeff": xeff_grid.ravel(),
+            f"p_{param_key}_and_xeff": to_numpy(xp.asarray(p)).ravel(),
+        })
+        probability_cacher.append_probabilities(df, fname, chunk=c, key=key)
+    return fname
+
+
+def get_run_key(prior, params, xeffs, chunk_size, method):
+    """Identifies the settings that the chunks stored in a file were computed with."""
+    return probability_cacher.cache_key(
+        prior, mc_samples=MC_SAMPLES if method == "mc" else None,
+        params=params, xeffs=xeffs, chunk_size=chunk_size, method=method
+    )
+
+
+def split_into_chunks(xeffs, chunk_size):
+    return [xeffs[i:i + chunk_size] for i in range(0, len(xeffs), chunk_size)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compute a p(param and xeff) table, resumably")
+    parser.add_argument("--param", default="a1", choices=list(PARAM_RANGES.keys()))
+    parser.add_argument("--num-params", type=int, default=1000)
+    parser.add_argument("--num-xeffs", type=int, default=1000)
+    parser.add_argument("--chunk-size", type=int, default=10, help="xeffs per chunk")
+    parser.add_argument("--method", default="mc", choices=["mc", "analytic"])
+    parser.add_argument("--outdir", default=OUTDIR)
+    add_shard_arguments(parser)
+    args = parser.parse_args()
+    os.makedirs(args.outdir, exist_ok=True)
+    params, xeffs = get_grid(args.param, args.num_params, args.num_xeffs)
+    fname = os.path.join(args.outdir, f"p_{args.param}_and_xeff.h5")
+    chunks = shard_items(list(range(len(split_into_chunks(xeffs, args.chunk_size)))), args.shard, args.num_shards)
+    fname = shard_fname(fname, args.shard, args.num_shards)
+    compute_and_store_p_param_and_xeff(
+        args.param, fname, params, xeffs, chunk_size=args.chunk_size, method=args.method, chunks=chunks
+    )
+    print(f"Saved {fname}")
+
+
+if __name__ == '__main__':
+    main()
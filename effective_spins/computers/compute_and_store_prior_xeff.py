@@ -1,33 +1,56 @@
+import argparse
 import os
+from concurrent.futures import ProcessPoolExecutor
 
-import matplotlib.pyplot as plt
 import pandas as pd
 from tqdm.auto import tqdm
 
-plt.style.use(
-    'https://gist.githubusercontent.com/avivajpeyi/4d9839b1ceb7d3651cbb469bc6b0d69b/raw/4ee4a870126653d542572372ff3eee4e89abcab0/publication.mplstyle')
-
 from effective_spins import probability_cacher
+from effective_spins.computers.merge_shards import add_shard_arguments, shard_fname, shard_items
 from effective_spins.priors_conditional_on_xeff import p_xeff
 
 OUTDIR = "p_xeff"
 
 
-def compute_and_store_p_xeff(p_a1_and_xeff_fname):
+def compute_and_store_p_xeff(p_a1_and_xeff_fname, n_workers=1, shard=0, num_shards=1):
     df = probability_cacher.load_probabilities(p_a1_and_xeff_fname)
-    data = {"p_xeff": [], "xeff": []}
-    for xeff in tqdm(df.xeff.unique(), desc="calculating p(xeff)"):
-        d = df[df['xeff'] == xeff]
-        data['xeff'].append(xeff)
-        data['p_xeff'].append(p_xeff(xeff, a1s=d.a1, p_a1_and_xeff=d.p_a1_and_xeff))
-    df = pd.DataFrame(data)
-    fname = os.path.join(OUTDIR, f"p_xeff.h5")
+    xeffs = shard_items(sorted(df.xeff.unique()), shard, num_shards)
+    df = compute_p_xeff_table(df[df.xeff.isin(xeffs)], n_workers=n_workers)
+    fname = shard_fname(os.path.join(OUTDIR, f"p_xeff.h5"), shard, num_shards)
     probability_cacher.store_probabilities(df, fname)
-    plot_p_xeff(df.xeff, df.p_xeff, fname.replace('.h5', '.png'))
+    if num_shards == 1:
+        plot_p_xeff(df.xeff, df.p_xeff, fname.replace('.h5', '.png'))
     print(f"Saved {fname}")
 
 
+def compute_p_xeff_table(df, n_workers=1):
+    """
+    p(xeff) for every xeff in a p(a1 and xeff) table. The table is grouped
+    once and the xeff slices are farmed out to `n_workers` processes;
+    results come back in xeff order.
+    """
+    df = df.sort_values(['xeff', 'a1'])
+    slices = [(xeff, d.a1.values, d.p_a1_and_xeff.values) for xeff, d in df.groupby('xeff', sort=True)]
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            chunksize = max(1, len(slices) // (4 * n_workers))
+            results = executor.map(_p_xeff_of_slice, slices, chunksize=chunksize)
+            results = list(tqdm(results, total=len(slices), desc="calculating p(xeff)"))
+    else:
+        results = [_p_xeff_of_slice(s) for s in tqdm(slices, desc="calculating p(xeff)")]
+    return pd.DataFrame(dict(
+        p_xeff=[p for _, p in results],
+        xeff=[xeff for xeff, _ in results],
+    ))
+
+
+def _p_xeff_of_slice(xeff_slice):
+    xeff, a1s, p_a1_and_xeff = xeff_slice
+    return xeff, float(p_xeff(xeff, a1s=a1s, p_a1_and_xeff=p_a1_and_xeff))
+
+
 def plot_p_xeff(xeff, p_xeff, fname):
+    plt = probability_cacher.get_pyplot()
     plt.close('all')
     plt.plot(xeff, p_xeff, c='k')
     plt.ylabel('p(xeff)')
@@ -37,8 +60,14 @@ def plot_p_xeff(xeff, p_xeff, fname):
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Compute p(xeff) from a p(a1 and xeff) table")
+    parser.add_argument("--p-a1-and-xeff", default="p_param_and_xeff/p_a1_and_xeff.h5")
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes")
+    add_shard_arguments(parser)
+    args = parser.parse_args()
     os.makedirs(OUTDIR, exist_ok=True)
-    compute_and_store_p_xeff("p_param_and_xeff/p_a1_and_xeff.h5")
+    compute_and_store_p_xeff(args.p_a1_and_xeff, n_workers=args.workers, shard=args.shard,
+                             num_shards=args.num_shards)
 
 
 if __name__ == '__main__':
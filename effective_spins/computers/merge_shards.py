@@ -0,0 +1,51 @@
+"""Split grid computations across independent jobs and merge their outputs."""
+import argparse
+import os
+
+import pandas as pd
+
+from effective_spins import probability_cacher
+
+
+def add_shard_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--shard", type=int, default=0, help="index of this shard (0 <= shard < num-shards)")
+    parser.add_argument("--num-shards", type=int, default=1, help="number of independent jobs")
+
+
+def shard_items(items, shard, num_shards):
+    """Deterministic round-robin share of `items` for one shard."""
+    assert 0 <= shard < num_shards, f"shard {shard} not in [0, {num_shards})"
+    return items[shard::num_shards]
+
+
+def shard_fname(fname, shard, num_shards):
+    """p_a1_and_xeff.h5 -> p_a1_and_xeff.shard3of8.h5 (unchanged for a single shard)."""
+    if num_shards == 1:
+        return fname
+    root, ext = os.path.splitext(fname)
+    return f"{root}.shard{shard}of{num_shards}{ext}"
+
+
+def merge_shards(fname, num_shards):
+    """Combine the per-shard tables of `fname` into `fname`, sorted by xeff."""
+    shard_fnames = [shard_fname(fname, i, num_shards) for i in range(num_shards)]
+    missing = [f for f in shard_fnames if not os.path.isfile(f)]
+    if missing:
+        raise FileNotFoundError(f"Missing shards: {missing}")
+    df = pd.concat([probability_cacher.load_probabilities(f) for f in shard_fnames], ignore_index=True)
+    df = df.sort_values([c for c in ["xeff"] if c in df.columns] + [c for c in df.columns if c != "xeff"])
+    probability_cacher.store_probabilities(df.reset_index(drop=True), fname)
+    return fname
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge per-shard tables into one table")
+    parser.add_argument("fname", help="merged table, e.g. p_param_and_xeff/p_a1_and_xeff.h5")
+    parser.add_argument("--num-shards", type=int, required=True)
+    args = parser.parse_args()
+    merge_shards(args.fname, args.num_shards)
+    print(f"Saved {args.fname}")
+
+
+if __name__ == '__main__':
+    main()
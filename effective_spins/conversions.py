@@ -1,21 +1,33 @@
+from . import numba_kernels
 from .cupy_utils import xp
 
 
 def q_factor(q):
+    if numba_kernels.can_use(q) and numba_kernels.broadcast_1d(q) is not None:
+        return numba_kernels.q_factor(*numba_kernels.broadcast_1d(q))
     return ((3.0 + 4.0 * q) / (4.0 + 3.0 * q)) * q
 
 
 def calculate_xp_given_xeff(xeff, a1, a2, q, cos1, cos2, tan1, tan2):
+    args = (xeff, a1, a2, q, cos1, cos2, tan1, tan2)
+    if numba_kernels.can_use(*args) and numba_kernels.broadcast_1d(*args) is not None:
+        return numba_kernels.calculate_xp_given_xeff(*numba_kernels.broadcast_1d(*args))
     case1 = (xeff * (1 + q) - a2 * q * cos2) * tan1
     case2 = (xeff + q * xeff - a1 * cos1) * tan2 * q_factor(q)
     return xp.maximum(case1, case2)
 
 
 def calculate_xp(a1, a2, q, sin1, sin2):
+    args = (a1, a2, q, sin1, sin2)
+    if numba_kernels.can_use(*args) and numba_kernels.broadcast_1d(*args) is not None:
+        return numba_kernels.calculate_xp(*numba_kernels.broadcast_1d(*args))
     case1 = a1 * sin1
     case2 = a2 * sin2 * q_factor(q)
     return xp.maximum(case1, case2)
 
 
 def calculate_xeff(a1, a2, cos1, cos2, q):
+    args = (a1, a2, cos1, cos2, q)
+    if numba_kernels.can_use(*args) and numba_kernels.broadcast_1d(*args) is not None:
+        return numba_kernels.calculate_xeff(*numba_kernels.broadcast_1d(*args))
     return ((a1 * cos1) + (q * a2 * cos2)) / (1.0 + q)
@@ -1,22 +1,132 @@
-"""Cupy utils to speed up integration. Taken for gwpop."""
-try:
-    import cupy as xp
+"""
+Cupy utils to speed up integration. Taken for gwpop.
 
-    CUPY_LOADED = True
-except ImportError as e:
-    print(f"Cupy cant be loaded: {e}")
-    import numpy as xp
+`xp` forwards to the array module of the active backend, which is chosen at
+runtime with `set_backend` or the EFFECTIVE_SPINS_BACKEND environment
+variable (default: cupy if it can be imported, else numpy). Backends:
+  numpy, cupy, jax (jax.numpy in float64) and numexpr (numpy, with
+  `uniform_pdf` evaluated by a multi-threaded numexpr kernel; everything
+  else runs as plain numpy).
+jax arrays are immutable, so code written against `xp` must not assign
+into arrays (use `xp.where`, concatenation or stacking instead).
+Further backends can be added with `register_backend`.
+"""
+import os
+from typing import Callable, Dict, Optional
 
-    CUPY_LOADED = False
+BACKEND_ENV_VAR = "EFFECTIVE_SPINS_BACKEND"
+
+
+class Backend:
+    """An array module plus the few operations that differ between backends."""
+
+    def __init__(self, name: str, module, to_numpy: Callable, kernels: Optional[Dict[str, Callable]] = None):
+        self.name = name
+        self.module = module
+        self.to_numpy = to_numpy
+        self.kernels = {} if kernels is None else kernels
+
+    def __repr__(self):
+        return f"Backend({self.name})"
+
+
+def _load_numpy():
+    import numpy
+    return Backend("numpy", numpy, to_numpy=lambda array: array)
+
+
+def _load_cupy():
+    import cupy
+    return Backend("cupy", cupy, to_numpy=cupy.asnumpy)
+
+
+def _load_jax():
+    import jax
+    jax.config.update("jax_enable_x64", True)
+    import jax.numpy
+    import numpy
+    return Backend("jax", jax.numpy, to_numpy=numpy.asarray)
+
+
+def _load_numexpr():
+    import numexpr
+    import numpy
+    numexpr.set_num_threads(numexpr.detect_number_of_cores())
+
+    def ne_uniform_pdf(x, loc=0.0, scale=1.0):
+        return numexpr.evaluate(
+            "where(scale > 0, where((x >= loc) & (x <= loc + scale), 1.0 / scale, 0.0), nan)",
+            local_dict=dict(x=x, loc=loc, scale=scale, nan=numpy.nan)
+        )
+
+    return Backend("numexpr", numpy, to_numpy=lambda array: array, kernels=dict(uniform_pdf=ne_uniform_pdf))
+
+
+BACKENDS = dict(numpy=_load_numpy, cupy=_load_cupy, jax=_load_jax, numexpr=_load_numexpr)
+_ACTIVE_BACKEND = []
+
+
+def register_backend(name: str, loader: Callable[[], Backend]):
+    """Make `set_backend(name)` available; `loader` raises ImportError if it cannot be used."""
+    BACKENDS[name] = loader
+
+
+def set_backend(name: str) -> Backend:
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown backend {name}, choose from {list(BACKENDS.keys())}")
+    backend = BACKENDS[name]()
+    _ACTIVE_BACKEND[:] = [backend]
+    return backend
+
+
+def get_backend() -> Backend:
+    """The active backend, chosen on first use if `set_backend` was not called."""
+    if len(_ACTIVE_BACKEND) == 0:
+        name = os.environ.get(BACKEND_ENV_VAR, "")
+        if name:
+            return set_backend(name)
+        try:
+            return set_backend("cupy")
+        except ImportError:
+            return set_backend("numpy")
+    return _ACTIVE_BACKEND[0]
+
+
+class _ArrayModule:
+    """Forwards attribute access (xp.linspace, xp.ndarray, ...) to the active backend's module."""
+
+    def __getattr__(self, name):
+        return getattr(get_backend().module, name)
+
+    def __repr__(self):
+        return f"xp({get_backend().name})"
+
+
+xp = _ArrayModule()
+
+
+def __getattr__(name):
+    if name == "CUPY_LOADED":
+        return get_backend().name == "cupy"
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-from scipy.stats import uniform
 
 def to_numpy(array):
     """Cast any array to numpy"""
-    if not CUPY_LOADED:
-        return array
-    else:
-        return xp.asnumpy(array)
+    return get_backend().to_numpy(array)
+
+
+def uniform_pdf(x, loc=0.0, scale=1.0):
+    """
+    scipy.stats.uniform.pdf on xp arrays: 1/scale on [loc, loc + scale],
+    0 outside and nan where scale <= 0.
+    """
+    kernel = get_backend().kernels.get("uniform_pdf")
+    if kernel is not None:
+        return kernel(x, loc, scale)
+    scale_safe = xp.where(scale > 0, scale, 1.0)
+    pdf = xp.where((x >= loc) & (x <= loc + scale_safe), 1.0 / scale_safe, 0.0)
+    return xp.where(scale > 0, pdf, xp.nan)
 
 
 def trapz(y, x=None, dx=1.0, axis=-1):
@@ -74,11 +184,11 @@ def trapz(y, x=None, dx=1.0, axis=-1):
     >>> xp.trapz(a, axis=1)
     array([ 2.,  8.])
     """
-    y = xp.asanyarray(y)
+    y = xp.asarray(y)
     if x is None:
         d = dx
     else:
-        x = xp.asanyarray(x)
+        x = xp.asarray(x)
         if x.ndim == 1:
             d = diff(x)
             # reshape to correct shape
@@ -168,7 +278,7 @@ def diff(a, n=1, axis=-1):
     if n < 0:
         raise ValueError("order must be non-negative but got " + repr(n))
 
-    a = xp.asanyarray(a)
+    a = xp.asarray(a)
     nd = a.ndim
 
     slice1 = [slice(None)] * nd
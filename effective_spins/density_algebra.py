@@ -0,0 +1,191 @@
+"""
+Densities of expressions of independent random variables, e.g.
+
+    A1, A2, Q, C2 = [Density.from_pdf(p, support) for p, support in ...]
+    c = xeff * (Q + 1) / A1 - A2 * Q * C2 / A1
+
+Operators build an expression graph; `tabulate` evaluates it with the
+`distribution_rules` kernels, one node at a time, on grids spanning each
+node's support (derived from the leaves' supports, and cut to the domain
+an operation reads, e.g. [0, 1] for sqrt_1_minus_x2, or to a range given
+with `restrict`). Every occurrence of a variable is treated as independent,
+as in the rules themselves.
+Structurally identical subexpressions (e.g. both 1/A1 above) are
+tabulated once.
+"""
+from numbers import Number
+from typing import Callable, Dict, Optional, Tuple
+
+from .cupy_utils import xp
+from .distribution_rules import (
+    TabulatedDensity,
+    adaptive_grid,
+    inverse_distribution,
+    product_distribution,
+    sqrt_1_minus_x2_distribution,
+    sum_distribution,
+    translate_distribution,
+)
+
+NUM_POINTS = 1000
+INVERSE_LIMIT = 10.0  # supports of 1/x are clipped to [-INVERSE_LIMIT, INVERSE_LIMIT]
+
+
+class Density:
+    """
+    A node of a density expression: a leaf (a pdf on a support) or an
+    operation ("affine", "sum", "product", "inverse", "sqrt_1_minus_x2")
+    on other nodes.
+    """
+
+    def __init__(self, op: str, args: Tuple["Density", ...] = (), params: tuple = (),
+                 pdf: Optional[Callable] = None, support: Optional[Tuple[float, float]] = None):
+        self.op = op
+        self.args = args
+        self.params = params
+        self.pdf = pdf
+        self.support = _support(op, args, params) if support is None else tuple(map(float, support))
+        if not self.support[0] < self.support[1]:
+            raise ValueError(f"Empty support {self.support} for {op}")
+        if pdf is None:
+            self.key = (op, params, tuple(arg.key for arg in args), self.support)
+        else:
+            self.key = (op, id(pdf), self.support)
+
+    @classmethod
+    def from_pdf(cls, pdf: Callable, support: Optional[Tuple[float, float]] = None) -> "Density":
+        """A variable with density `pdf` on `support` (default: the grid of a TabulatedDensity)."""
+        if support is None:
+            if not isinstance(pdf, TabulatedDensity):
+                raise ValueError("A support is needed unless pdf is a TabulatedDensity")
+            support = (float(pdf.x[0]), float(pdf.x[-1]))
+        return cls("leaf", pdf=pdf, support=support)
+
+    def __add__(self, other):
+        if isinstance(other, Number):
+            return self.affine(1.0, other)
+        return Density("sum", (self, other))
+
+    __radd__ = __add__
+
+    def __neg__(self):
+        return self.affine(-1.0, 0.0)
+
+    def __sub__(self, other):
+        return self + (-other)
+
+    def __rsub__(self, other):
+        return (-self) + other
+
+    def __mul__(self, other):
+        if isinstance(other, Number):
+            return self.affine(other, 0.0)
+        return Density("product", (self, other))
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, other):
+        if isinstance(other, Number):
+            return self.affine(1.0 / other, 0.0)
+        return self * other.inverse()
+
+    def __rtruediv__(self, other):
+        return other * self.inverse()
+
+    def affine(self, scale: float, shift: float) -> "Density":
+        """scale * self + shift"""
+        if scale == 0:
+            raise ValueError("Cannot scale a density by 0")
+        return Density("affine", (self,), (float(scale), float(shift)))
+
+    def inverse(self) -> "Density":
+        """1 / self"""
+        return Density("inverse", (self,))
+
+    def restrict(self, low: float, high: float) -> "Density":
+        """The same density, tabulated only on the part of its support in [low, high]"""
+        support = (max(self.support[0], low), min(self.support[1], high))
+        return Density(self.op, self.args, self.params, pdf=self.pdf, support=support)
+
+    def sqrt_1_minus_x2(self) -> "Density":
+        """sqrt(1 - self^2), for the part of self in [0, 1]"""
+        return Density("sqrt_1_minus_x2", (self.restrict(0.0, 1.0),))
+
+    def tabulate(self, num_points: int = NUM_POINTS, tolerance: Optional[float] = None,
+                 initial_points: int = 129, cache: Optional[Dict] = None,
+                 product_method: str = "batch") -> TabulatedDensity:
+        """
+        The density on `num_points` uniform points over its support, or on an
+        `adaptive_grid` if a tolerance is given. Pass the same `cache` dict
+        (with the same `product_method`) to share intermediate results
+        between expressions. `product_method` is passed to
+        `product_distribution` for every product node ("mellin": O(N log N)).
+        """
+        cache = {} if cache is None else cache
+        if self.key in cache:
+            return cache[self.key]
+        if self.op == "leaf" and isinstance(self.pdf, TabulatedDensity) and tolerance is None \
+                and self.support == (float(self.pdf.x[0]), float(self.pdf.x[-1])):
+            cache[self.key] = self.pdf
+            return self.pdf
+        args = [arg.tabulate(num_points, tolerance, initial_points, cache, product_method) for arg in self.args]
+        rule = self._rule(*args, product_method=product_method)
+        low, high = self.support
+        if tolerance is None:
+            z = xp.linspace(low, high, num_points)
+            # e.g. a singular end point; set to 0 as in `adaptive_grid`
+            p = xp.nan_to_num(rule(z), nan=0.0, posinf=0.0, neginf=0.0)
+        else:
+            z, p = adaptive_grid(rule, low, high, tolerance=tolerance, initial_points=initial_points)
+        cache[self.key] = TabulatedDensity(z, p)
+        return cache[self.key]
+
+    def _rule(self, *args: TabulatedDensity, product_method: str = "batch") -> Callable:
+        """f(z) of this node in terms of its arguments' tabulated densities."""
+        if self.op == "leaf":
+            return self.pdf
+        elif self.op == "affine":
+            scale, shift = self.params
+            return lambda z: translate_distribution(z_vals=z, pdf_a=args[0], scale=scale, translate=shift)
+        elif self.op == "sum":
+            return lambda z: sum_distribution(z_vals=z, a_vals=args[0].x, pdf_a=args[0], pdf_b=args[1])
+        elif self.op == "product":
+            return lambda z: product_distribution(
+                z_vals=z, a_vals=args[0].x, pdf_a=args[0], pdf_b=args[1], method=product_method
+            )
+        elif self.op == "inverse":
+            return lambda z: inverse_distribution(z_vals=z, pdf_a=args[0])
+        elif self.op == "sqrt_1_minus_x2":
+            return lambda z: sqrt_1_minus_x2_distribution(z_vals=z, pdf_a=args[0])
+        raise ValueError(f"Unknown operation {self.op}")
+
+    def __repr__(self):
+        if self.op == "leaf":
+            return f"Density({getattr(self.pdf, '__name__', type(self.pdf).__name__)}, {self.support})"
+        return f"{self.op}{self.params or ''}({', '.join(map(repr, self.args))})"
+
+
+def _support(op: str, args: Tuple[Density, ...], params: tuple) -> Tuple[float, float]:
+    """Support of an operation's result from its arguments' supports."""
+    if op == "affine":
+        scale, shift = params
+        ends = [scale * x + shift for x in args[0].support]
+    elif op == "sum":
+        ends = [args[0].support[0] + args[1].support[0], args[0].support[1] + args[1].support[1]]
+    elif op == "product":
+        ends = [a * b for a in args[0].support for b in args[1].support]
+    elif op == "inverse":
+        low, high = args[0].support
+        if low >= 0:
+            ends = [1 / high, INVERSE_LIMIT if low == 0 else 1 / low]
+        elif high <= 0:
+            ends = [-INVERSE_LIMIT if high == 0 else 1 / high, 1 / low]
+        else:
+            ends = [-INVERSE_LIMIT, INVERSE_LIMIT]
+        ends = [min(max(x, -INVERSE_LIMIT), INVERSE_LIMIT) for x in ends]
+    elif op == "sqrt_1_minus_x2":
+        low, high = args[0].support
+        ends = [(1 - high ** 2) ** 0.5, (1 - low ** 2) ** 0.5]
+    else:
+        raise ValueError(f"Unknown operation {op}")
+    return min(ends), max(ends)
@@ -1,8 +1,65 @@
+from __future__ import annotations
+
 from typing import Callable, Optional
 
-from scipy.interpolate import interp1d
+import numpy as np
+
+from . import numba_kernels
+from .cupy_utils import diff, trapz, xp
+
+
+MAX_BATCH_ELEMENTS = 2 ** 22
+MAX_FFT_POINTS = 2 ** 24
 
-from .cupy_utils import trapz, xp
+
+class TabulatedDensity:
+    """
+    A density tabulated at increasing grid points `x`, linearly interpolated
+    between them and zero outside [x[0], x[-1]]. Uniform grids are evaluated
+    by index arithmetic, other grids with `xp.interp` (or a search).
+
+    `p` may have leading batch dimensions, one density per row on the
+    shared grid; evaluating at z then gives an array of shape
+    p.shape[:-1] + z.shape. The rules accept such batched densities and use
+    the tabulated values directly (no interpolation) when a
+    TabulatedDensity is integrated over its own grid.
+    """
+
+    def __init__(self, x: xp.ndarray, p: xp.ndarray):
+        self.x = xp.asarray(x, dtype=float)
+        self.p = xp.asarray(p, dtype=float)
+        self.uniform = is_uniform(self.x)
+        self._x0 = float(self.x[0])
+        self._dx = float(self.x[-1] - self.x[0]) / max(len(self.x) - 1, 1)
+        self._slopes = diff(self.p)
+
+    def __call__(self, z: xp.ndarray) -> xp.ndarray:
+        z = xp.asarray(z, dtype=float)
+        if self.uniform:
+            pos = (z - self._x0) / self._dx
+            # fmax/fmin map nan to a valid index (the value is masked below)
+            i = xp.fmin(xp.fmax(pos, 0), len(self.x) - 2).astype(int)
+            vals = self.p[..., i] + (pos - i) * self._slopes[..., i]
+        elif self.p.ndim == 1:
+            vals = xp.interp(z, self.x, self.p)
+        else:
+            i = xp.clip(xp.searchsorted(self.x, z, side="right") - 1, 0, len(self.x) - 2)
+            vals = self.p[..., i] + (z - self.x[i]) / diff(self.x)[i] * self._slopes[..., i]
+        return xp.where((z >= self.x[0]) & (z <= self.x[-1]), vals, 0.0)
+
+    def on_grid(self, vals: xp.ndarray) -> bool:
+        """True if `vals` is this density's grid."""
+        if vals is self.x:
+            return True
+        vals = xp.asarray(vals)
+        return vals.shape == self.x.shape and bool(xp.all(vals == self.x))
+
+
+def evaluate_pdf(pdf: Callable, vals: xp.ndarray, kwargs={}) -> xp.ndarray:
+    """pdf(vals, **kwargs), or the tabulated values of a TabulatedDensity on this grid."""
+    if isinstance(pdf, TabulatedDensity) and len(kwargs) == 0 and pdf.on_grid(vals):
+        return pdf.p
+    return pdf(vals, **kwargs)
 
 
 def product_distribution(
@@ -12,16 +69,100 @@ def product_distribution(
         pdf_b: Callable,
         kwargs_a={},
         kwargs_b={},
+        method: str = "batch",
+        chunk_size: Optional[int] = None,
 ):
     """
     f_{Z}(z) = int f_{A}(a) f_{B}(z/a) 1/|a| da
+
+    method: "loop" integrates one z at a time, "batch" evaluates the z-a grid
+    in chunks of `chunk_size` z values (see `batch_integrate`), "mellin"
+    convolves in log space (see `mellin_product_distribution`).
     """
-    fz = xp.zeros(len(z_vals))
-    for i, z in enumerate(z_vals):
-        fa = pdf_a(a_vals, **kwargs_a)
-        fb = pdf_b(xp.nan_to_num(z / a_vals), **kwargs_b)
-        fz[i] = trapz(y=fa * fb * xp.nan_to_num(1 / xp.abs(a_vals)), x=a_vals)
-    return fz
+    if method == "mellin":
+        fz = mellin_product_distribution(z_vals, a_vals, pdf_a, pdf_b, kwargs_a, kwargs_b)
+        if fz is not None:
+            return fz
+        method = "batch"
+    fa = evaluate_pdf(pdf_a, a_vals, kwargs_a)
+    # the a = 0 node (if on the grid) contributes nothing
+    inv_abs_a = xp.where(a_vals == 0, 0.0, 1 / xp.where(a_vals == 0, 1.0, xp.abs(a_vals)))
+    if method == "loop":
+        fz = [
+            trapz(y=fa * pdf_b(xp.nan_to_num(z / a_vals), **kwargs_b) * inv_abs_a, x=a_vals)
+            for z in z_vals
+        ]
+        return xp.stack(fz) if len(fz) > 0 else xp.zeros(0)
+    elif method == "batch":
+        return batch_integrate(
+            z_vals, a_vals, weights=fa * inv_abs_a,
+            pdf_b=lambda z, a: pdf_b(xp.nan_to_num(z / a), **kwargs_b),
+            chunk_size=chunk_size
+        )
+    raise ValueError(f"Unknown method {method} for product_distribution")
+
+
+def mellin_product_distribution(
+        z_vals: xp.ndarray,
+        a_vals: xp.ndarray,
+        pdf_a: Callable,
+        pdf_b: Callable,
+        kwargs_a={},
+        kwargs_b={},
+) -> Optional[xp.ndarray]:
+    """
+    f_{Z}(z) = int f_{A}(a) f_{B}(z/a) 1/|a| da, in O(N log N)
+
+    With u = log|a|, v = log|b|, w = log|z| = u + v, for each sign (s_a, s_b)
+        g_{A}(u) = f_{A}(s_a e^u) e^u,   g_{B}(v) = f_{B}(s_b e^v) e^v
+    are convolved on a shared uniform log grid and
+        f_{Z}(z) = sum_{s_a s_b = sign(z)} (g_{A} * g_{B})(log|z|) / |z|.
+    The log grid spans the non-zero |a_vals| with len(a_vals) points, so a
+    is integrated over [min(a_vals), max(a_vals)] as in the direct rule.
+    f_{Z}(0) is returned as 0.
+    Returns None if the grids are degenerate or exceed MAX_FFT_POINTS.
+    """
+    z_vals = xp.asarray(z_vals)
+    a_vals = xp.asarray(a_vals)
+    abs_a = xp.abs(a_vals[a_vals != 0])
+    abs_z = xp.abs(z_vals[z_vals != 0])
+    if len(abs_a) < 2 or len(abs_z) == 0:
+        return None
+    u_lo, u_hi = float(xp.log(xp.min(abs_a))), float(xp.log(xp.max(abs_a)))
+    if u_hi <= u_lo:
+        return None
+    n = len(a_vals)
+    h = (u_hi - u_lo) / (n - 1)
+    v0 = float(xp.log(xp.min(abs_z))) - u_hi
+    m = int(xp.ceil((float(xp.log(xp.max(abs_z))) - u_lo - v0) / h)) + 1
+    if m > MAX_FFT_POINTS:
+        return None
+    exp_u = xp.exp(u_lo + h * xp.arange(n))
+    exp_v = xp.exp(v0 + h * xp.arange(m))
+    a_min, a_max = xp.min(a_vals), xp.max(a_vals)
+    w = trapz_weights(n)
+
+    fz_by_sign = {1: 0, -1: 0}
+    for sign_a in [1, -1]:
+        a = sign_a * exp_u
+        in_range = (a >= a_min) & (a <= a_max)
+        if not bool(xp.any(in_range)):
+            continue
+        ga = pdf_a(a, **kwargs_a) * exp_u * w * in_range
+        for sign_b in [1, -1]:
+            gb = pdf_b(sign_b * exp_v, **kwargs_b) * exp_v
+            fz_by_sign[sign_a * sign_b] = fz_by_sign[sign_a * sign_b] + h * fft_convolve(ga, gb)
+
+    w_vals = u_lo + v0 + h * xp.arange(n + m - 1)
+    log_abs_z = xp.log(xp.where(z_vals == 0, 1, xp.abs(z_vals)))
+    fz = xp.zeros(z_vals.shape)
+    for sign, fw in fz_by_sign.items():
+        if isinstance(fw, int):
+            continue
+        # 0 outside the log grid; keeps any batch dimensions of fw
+        fw = TabulatedDensity(w_vals, xp.maximum(fw, 0))(log_abs_z)
+        fz = fz + xp.where(sign * z_vals > 0, fw, 0)
+    return fz / xp.where(z_vals == 0, 1, xp.abs(z_vals))
 
 
 def sum_distribution(
@@ -31,16 +172,200 @@ def sum_distribution(
         pdf_b: Callable,
         kwargs_a={},
         kwargs_b={},
+        method: str = "auto",
+        chunk_size: Optional[int] = None,
 ):
     """
     f_{Z}(z) = sum_{a in A} f_{A}(a) f_{B}(z-a) da
+
+    method: "loop" integrates one z at a time, "batch" evaluates the z-a grid
+    in chunks of `chunk_size` z values (see `batch_integrate`), "fft"
+    convolves on the uniform `a_vals` grid (see `fft_sum_distribution`).
+    "auto" uses "fft" when `a_vals` is uniformly spaced, else "batch".
+    """
+    if method == "auto":
+        method = "fft" if is_uniform(a_vals) else "batch"
+    if method == "fft":
+        fz = fft_sum_distribution(z_vals, a_vals, pdf_a, pdf_b, kwargs_a, kwargs_b)
+        if fz is not None:
+            return fz
+        method = "batch"
+    fa = evaluate_pdf(pdf_a, a_vals, kwargs_a)
+    if method == "loop":
+        fz = [trapz(y=fa * pdf_b(xp.nan_to_num(z - a_vals), **kwargs_b), x=a_vals) for z in z_vals]
+        return xp.stack(fz) if len(fz) > 0 else xp.zeros(0)
+    elif method == "batch":
+        return batch_integrate(
+            z_vals, a_vals, weights=fa,
+            pdf_b=lambda z, a: pdf_b(xp.nan_to_num(z - a), **kwargs_b),
+            chunk_size=chunk_size
+        )
+    raise ValueError(f"Unknown method {method} for sum_distribution")
+
+
+def fft_sum_distribution(
+        z_vals: xp.ndarray,
+        a_vals: xp.ndarray,
+        pdf_a: Callable,
+        pdf_b: Callable,
+        kwargs_a={},
+        kwargs_b={},
+) -> Optional[xp.ndarray]:
     """
-    fz = xp.zeros(len(z_vals))
-    for i, z in enumerate(z_vals):
-        fa = pdf_a(a_vals, **kwargs_a)
-        fb = pdf_b(xp.nan_to_num(z - a_vals), **kwargs_b)
-        fz[i] = trapz(y=fa * fb, x=a_vals)
-    return fz
+    f_{Z}(z) = int f_{A}(a) f_{B}(z-a) da, in O(N log N)
+
+    pdf_b is sampled on a grid with the same spacing h as `a_vals`, starting
+    at min(z) - max(a), so the discrete convolution
+        f_{Z}(a_0 + b_0 + k h) = h sum_i w_i f_{A}(a_i) f_{B}(b_{k-i})
+    (w_i the trapezoid weights) reproduces the quadrature on that grid.
+    Values at `z_vals` are linearly interpolated from it.
+    Returns None if `a_vals` is not uniformly spaced (see `is_uniform`) or
+    the required b-grid exceeds MAX_FFT_POINTS.
+    """
+    z_vals = xp.asarray(z_vals)
+    a_vals = xp.asarray(a_vals)
+    if not is_uniform(a_vals):
+        return None
+    n = len(a_vals)
+    h = float(a_vals[-1] - a_vals[0]) / (n - 1)
+    b0 = float(xp.min(z_vals)) - float(a_vals[-1])
+    m = int(xp.ceil((float(xp.max(z_vals)) - float(a_vals[0]) - b0) / h)) + 1
+    if m > MAX_FFT_POINTS:
+        return None
+    b_vals = b0 + h * xp.arange(m)
+    fa = evaluate_pdf(pdf_a, a_vals, kwargs_a) * trapz_weights(n)
+    fb = pdf_b(b_vals, **kwargs_b)
+    fz = xp.maximum(h * fft_convolve(fa, fb), 0)
+    s_vals = float(a_vals[0]) + b0 + h * xp.arange(fz.shape[-1])
+    return TabulatedDensity(s_vals, fz)(z_vals)
+
+
+def fft_convolve(x: xp.ndarray, y: xp.ndarray) -> xp.ndarray:
+    """Full linear convolution of x and y along the last axis via rfft."""
+    n = x.shape[-1] + y.shape[-1] - 1
+    n_fft = 1 << (n - 1).bit_length()
+    fx = xp.fft.rfft(x, n_fft, axis=-1)
+    fy = xp.fft.rfft(y, n_fft, axis=-1)
+    return xp.fft.irfft(fx * fy, n_fft, axis=-1)[..., :n]
+
+
+def trapz_weights(n: int) -> xp.ndarray:
+    """Trapezoid weights (1/2, 1, ..., 1, 1/2) for n uniformly spaced points."""
+    half = xp.full(1, 0.5)
+    return xp.concatenate([half, xp.ones(n - 2), half])
+
+
+def is_uniform(vals: xp.ndarray, rtol: float = 1e-6) -> bool:
+    """True if vals is increasing with constant spacing (to rtol)."""
+    vals = xp.asarray(vals)
+    if vals.ndim != 1 or len(vals) < 3:
+        return False
+    d = diff(vals)
+    h = (vals[-1] - vals[0]) / (len(vals) - 1)
+    return bool(h > 0) and bool(xp.all(xp.abs(d - h) <= rtol * h))
+
+
+def batch_integrate(
+        z_vals: xp.ndarray,
+        a_vals: xp.ndarray,
+        weights: xp.ndarray,
+        pdf_b: Callable,
+        chunk_size: Optional[int] = None,
+) -> xp.ndarray:
+    """
+    f_{Z}(z) = int w(a) f_{B}(z, a) da, for all z at once
+
+    The (z, a) grid is broadcast in blocks of `chunk_size` z values
+    (default: MAX_BATCH_ELEMENTS // (len(a_vals) * batch size)) so memory
+    stays bounded. `pdf_b` is evaluated once per block on a flattened array,
+    and the weighted trapezoid sum uses the fused numba kernel when available.
+    `weights` and the values of `pdf_b` may have leading batch dimensions
+    (see `TabulatedDensity`), which are kept in the result.
+    """
+    z_vals = xp.asarray(z_vals)
+    a_vals = xp.asarray(a_vals)
+    weights = xp.asarray(weights)
+    if chunk_size is None:
+        batch_size = int(np.prod(weights.shape[:-1]))
+        chunk_size = max(1, MAX_BATCH_ELEMENTS // max(len(a_vals) * batch_size, 1))
+    fz = []
+    for start in range(0, len(z_vals), chunk_size):
+        z = z_vals[start:start + chunk_size, None]
+        args = xp.broadcast_arrays(z, a_vals[None, :])
+        fb = pdf_b(args[0].ravel(), args[1].ravel())
+        fb = xp.reshape(fb, fb.shape[:-1] + args[0].shape)
+        if fb.ndim == 2 and weights.ndim == 1 and numba_kernels.can_use(fb, weights, a_vals):
+            fz.append(numba_kernels.weighted_trapz_rows(fb, weights, a_vals))
+        else:
+            fz.append(trapz(y=weights[..., None, :] * fb, x=a_vals, axis=-1))
+    if len(fz) == 0:
+        return xp.zeros(weights.shape[:-1] + (0,))
+    return xp.concatenate(fz, axis=-1)
+
+
+def adaptive_grid(
+        pdf: Callable,
+        low: float,
+        high: float,
+        tolerance: float = 1e-4,
+        initial_points: int = 129,
+        max_points: int = 2 ** 14,
+):
+    """
+    A non-uniform grid (and the pdf on it) on which linear interpolation of
+    `pdf` over [low, high] has an L1 error below about `tolerance` times its mass.
+
+    The support is located on `initial_points` uniform points (the range is
+    cut to the outermost non-zero values and one zero beyond them). Each
+    interval's error is estimated from its midpoint,
+        e_i = |f(mid_i) - (f(z_i) + f(z_{i+1})) / 2| * (z_{i+1} - z_i),
+    and while sum(e_i) > tolerance * mass, intervals with more than the mean
+    allowance tolerance * mass / n_intervals are bisected (the midpoint is
+    already known, so `pdf` is only called, once per round, for the new
+    midpoints). Stops at `max_points`. Non-finite values (e.g. at a
+    singular end point) are set to 0. Returns (grid, pdf values).
+
+    If `pdf` returns batched values (leading dimensions, see
+    `TabulatedDensity`), one grid is built for all of them, using the
+    largest relative error over the batch.
+    """
+    _pdf = lambda x: xp.nan_to_num(pdf(x), nan=0.0, posinf=0.0, neginf=0.0)
+    z = xp.linspace(low, high, initial_points)
+    f = _pdf(z)
+    nonzero = xp.nonzero(xp.any(xp.reshape(f > 0, (-1, initial_points)), axis=0))[0]
+    if len(nonzero) == 0:
+        return z, f
+    first = max(int(nonzero[0]) - 1, 0)
+    last = min(int(nonzero[-1]) + 1, initial_points - 1)
+    z, f = z[first:last + 1], f[..., first:last + 1]
+    mid = (z[1:] + z[:-1]) / 2
+    f_mid = _pdf(mid)
+    while len(z) < max_points:
+        mass = trapz(y=xp.abs(f), x=z, axis=-1)
+        inv_mass = xp.where(mass > 0, 1 / xp.where(mass > 0, mass, 1), 0)
+        error = xp.abs(f_mid - (f[..., 1:] + f[..., :-1]) / 2) * diff(z) * inv_mass[..., None]
+        error = xp.reshape(error, (-1, len(mid)))
+        if float(xp.max(xp.sum(error, axis=-1))) <= tolerance:
+            break
+        error = xp.max(error, axis=0)
+        refine = xp.nonzero(error > tolerance / len(error))[0]
+        # the worst intervals first, if not all of them fit
+        refine = refine[xp.argsort(error[refine])[::-1][:max_points - len(z)]]
+        left = (z[refine] + mid[refine]) / 2
+        right = (mid[refine] + z[refine + 1]) / 2
+        f_new = _pdf(xp.concatenate([left, right]))
+        f_left, f_right = f_new[..., :len(refine)], f_new[..., len(refine):]
+        # intervals keep their midpoints unless split into two halves
+        keep = ~xp.isin(xp.arange(len(mid)), refine)
+        z_all = xp.concatenate([z, mid[refine]])
+        order = xp.argsort(z_all)
+        z = z_all[order]
+        f = xp.concatenate([f, f_mid[..., refine]], axis=-1)[..., order]
+        mid_all = xp.concatenate([mid[keep], left, right])
+        order = xp.argsort(mid_all)
+        mid = mid_all[order]
+        f_mid = xp.concatenate([f_mid[..., keep], f_left, f_right], axis=-1)[..., order]
+    return z, f
 
 
 def inverse_distribution(z_vals, pdf_a, kwargs_a={}):
@@ -61,22 +386,33 @@ def translate_distribution(z_vals, pdf_a, scale=1.0, translate=0.0, kwargs_a={})
     return (1 / xp.abs(scale)) * pdf_a(((z_vals - translate) / scale), **kwargs_a)
 
 
-def prod_dist_interp(z_vals: xp.ndarray, a_vals: xp.ndarray, pdf_a: Callable, pdf_b: Callable) -> Callable:
+def sqrt_1_minus_x2_distribution(z_vals, pdf_a, kwargs_a={}):
+    """
+    z = sqrt(1-a^2), for a in [0, 1]
+    with h(z) = sqrt(1-z^2) (= a) and dh(z)/dz = -z/sqrt(1-z^2)
+    f_{Z}(z) = f_{A}(h(z)) * |dh(z)/dz|
+    """
+    h = xp.sqrt(1 - z_vals ** 2)
+    dh_dz = z_vals / h
+    return pdf_a(h, **kwargs_a) * xp.abs(dh_dz)
+
+
+def prod_dist_interp(z_vals: xp.ndarray, a_vals: xp.ndarray, pdf_a: Callable, pdf_b: Callable) -> TabulatedDensity:
     pdf_z = product_distribution(z_vals=z_vals, a_vals=a_vals, pdf_a=pdf_a, pdf_b=pdf_b)
-    return interp1d(x=z_vals, y=pdf_z, fill_value=0, bounds_error=False)
+    return TabulatedDensity(z_vals, pdf_z)
 
 
-def sum_dist_interp(z_vals: xp.ndarray, a_vals: xp.ndarray, pdf_a: Callable, pdf_b: Callable) -> Callable:
+def sum_dist_interp(z_vals: xp.ndarray, a_vals: xp.ndarray, pdf_a: Callable, pdf_b: Callable) -> TabulatedDensity:
     pdf_z = sum_distribution(z_vals=z_vals, a_vals=a_vals, pdf_a=pdf_a, pdf_b=pdf_b)
-    return interp1d(x=z_vals, y=pdf_z, fill_value=0, bounds_error=False)
+    return TabulatedDensity(z_vals, pdf_z)
 
 
-def inv_dist_interp(z_vals: xp.ndarray, pdf_a: Callable) -> Callable:
+def inv_dist_interp(z_vals: xp.ndarray, pdf_a: Callable) -> TabulatedDensity:
     pdf_z = inverse_distribution(z_vals=z_vals, pdf_a=pdf_a)
-    return interp1d(x=z_vals, y=pdf_z, fill_value=0, bounds_error=False)
+    return TabulatedDensity(z_vals, pdf_z)
 
 
 def translate_dist_interp(z_vals: xp.ndarray, pdf_a: Callable, scale: Optional[float] = 1.0,
-                          translate: Optional[float] = 0.0) -> Callable:
+                          translate: Optional[float] = 0.0) -> TabulatedDensity:
     pdf_z = translate_distribution(z_vals=z_vals, pdf_a=pdf_a, scale=scale, translate=translate)
-    return interp1d(x=z_vals, y=pdf_z, fill_value=0, bounds_error=False)
+    return TabulatedDensity(z_vals, pdf_z)
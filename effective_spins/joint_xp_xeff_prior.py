@@ -1,2 +1,132 @@
+"""
+Joint prior p(xp, xeff) implied by the traditional (isotropic, uniform
+magnitude) spin prior.
+"""
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Dict, Optional, Tuple
+
+import numpy as np
+
+from .conversions import calculate_xeff, calculate_xp
+from .cupy_utils import to_numpy, xp
+from .density_estimation import binned_kde, density_to_df
+from .priors_conditional_on_xeff import _unit_sampler, get_traditional_prior
+
+if TYPE_CHECKING:
+    import pandas as pd
+    from bilby.core.prior import PriorDict
+
+XEFF_RANGE = (-1.0, 1.0)
+XP_RANGE = (0.0, 1.0)
+GRID_SAMPLES = 10 ** 7
+BATCH_SIZE = 10 ** 6
+NUM_BINS = (400, 200)  # (xeff, xp)
+
+DEFAULT_PRIOR = None
+
+
+class JointXpXeffPrior:
+    """
+    p(xeff, xp) tabulated at bin centres of a regular (xeff, xp) grid.
+
+    `prob` is a bilinear lookup computed with index arithmetic (O(1) per
+    point), zero outside XEFF_RANGE x XP_RANGE. `sample` draws directly
+    from the spin prior through the `conversions` formulas.
+    """
+
+    def __init__(self, xeffs: np.ndarray, xps: np.ndarray, probs: np.ndarray,
+                 prior: Optional["PriorDict"] = None):
+        self.xeffs = np.asarray(xeffs, dtype=float)
+        self.xps = np.asarray(xps, dtype=float)
+        self.probs = np.asarray(probs, dtype=float)
+        self.prior = get_traditional_prior() if prior is None else prior
+        self._dxeff = self.xeffs[1] - self.xeffs[0]
+        self._dxp = self.xps[1] - self.xps[0]
+
+    @classmethod
+    def from_samples(cls, samples: Dict[str, np.ndarray], bins: Tuple[int, int] = NUM_BINS,
+                     bandwidth: Optional[Tuple[float, float]] = None,
+                     prior: Optional["PriorDict"] = None):
+        """
+        Binned KDE of {"xeff", "xp"} samples on a (bins[0], bins[1]) grid
+        (see `density_estimation.binned_kde`; bandwidth=(0, 0) is the histogram).
+        """
+        xeffs, xps, probs = binned_kde(
+            samples["xeff"], samples["xp"], XEFF_RANGE, XP_RANGE, bins=bins, bandwidth=bandwidth
+        )
+        return cls(to_numpy(xeffs), to_numpy(xps), to_numpy(probs), prior=prior)
+
+    @classmethod
+    def from_prior(cls, prior: Optional["PriorDict"] = None, num_samples: int = GRID_SAMPLES,
+                   bins: Tuple[int, int] = NUM_BINS, bandwidth: Optional[Tuple[float, float]] = None,
+                   seed: Optional[int] = None):
+        prior = get_traditional_prior() if prior is None else prior
+        samples = draw_xp_xeff(num_samples, prior, seed=seed)
+        return cls.from_samples(samples, bins=bins, bandwidth=bandwidth, prior=prior)
+
+    def to_df(self) -> "pd.DataFrame":
+        """The grid as an (xeff, xp, p_xp_and_xeff) table for `probability_cacher`."""
+        return density_to_df(self.xeffs, self.xps, self.probs)
+
+    def sample(self, size: int, seed: Optional[int] = None) -> Dict[str, xp.ndarray]:
+        return draw_xp_xeff(size, self.prior, seed=seed)
+
+    def prob(self, xeff, xp):
+        xeff = np.asarray(xeff, dtype=float)
+        xp = np.asarray(xp, dtype=float)
+        i, t = _bilinear_index(xeff, self.xeffs[0], self._dxeff, len(self.xeffs))
+        j, u = _bilinear_index(xp, self.xps[0], self._dxp, len(self.xps))
+        p = self.probs
+        prob = (
+            (1 - t) * (1 - u) * p[i, j] + t * (1 - u) * p[i + 1, j]
+            + (1 - t) * u * p[i, j + 1] + t * u * p[i + 1, j + 1]
+        )
+        inside = (
+            (xeff >= XEFF_RANGE[0]) & (xeff <= XEFF_RANGE[1])
+            & (xp >= XP_RANGE[0]) & (xp <= XP_RANGE[1])
+        )
+        prob = np.where(inside, prob, 0.0)
+        return prob if prob.ndim else float(prob)
+
+    def ln_prob(self, xeff, xp):
+        with np.errstate(divide="ignore"):
+            return np.log(self.prob(xeff, xp))
+
+
+def _bilinear_index(x: np.ndarray, x0: float, dx: float, n: int):
+    """Lower grid index and fractional offset, clamped to the end cells."""
+    pos = np.clip((x - x0) / dx, 0, n - 1)
+    i = np.minimum(pos.astype(int), n - 2)
+    return i, pos - i
+
+
+def draw_xp_xeff(num_samples: int, prior: Optional["PriorDict"] = None,
+                 batch_size: int = BATCH_SIZE, seed: Optional[int] = None) -> Dict[str, xp.ndarray]:
+    """Samples of (xeff, xp) from the spin prior, drawn in batches of `batch_size`."""
+    prior = get_traditional_prior() if prior is None else prior
+    keys = list(prior.keys())
+    unit_sampler = _unit_sampler("random", len(keys), seed)
+    xeffs, xps = [], []
+    for start in range(0, num_samples, batch_size):
+        unit = unit_sampler(min(batch_size, num_samples - start))
+        s = {k: xp.asarray(prior[k].rescale(unit[:, i])) for i, k in enumerate(keys)}
+        sin1 = xp.sqrt(1 - s["cos1"] ** 2)
+        sin2 = xp.sqrt(1 - s["cos2"] ** 2)
+        xeffs.append(calculate_xeff(a1=s["a1"], a2=s["a2"], cos1=s["cos1"], cos2=s["cos2"], q=s["q"]))
+        xps.append(calculate_xp(a1=s["a1"], a2=s["a2"], q=s["q"], sin1=sin1, sin2=sin2))
+    if len(xeffs) == 0:
+        return dict(xeff=xp.zeros(0), xp=xp.zeros(0))
+    return dict(xeff=xp.concatenate(xeffs), xp=xp.concatenate(xps))
+
+
+def get_default_prior() -> JointXpXeffPrior:
+    """The joint prior of the traditional spin prior, built on first use."""
+    global DEFAULT_PRIOR
+    if DEFAULT_PRIOR is None:
+        DEFAULT_PRIOR = JointXpXeffPrior.from_prior(seed=0)
+    return DEFAULT_PRIOR
+
+
 def p_xp_xeff(xeff, xp):
-    return 1
+    return get_default_prior().prob(xeff, xp)
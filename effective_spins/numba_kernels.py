@@ -0,0 +1,117 @@
+"""
+Optional numba-compiled CPU kernels: fused single-pass loops, parallel over
+the output, with no intermediate arrays. Used automatically (when numba is
+installed, USE_NUMBA is True and the numpy backend is active) by
+`conversions` and `distribution_rules`, which otherwise run their xp code.
+
+numba is only imported, and the kernels defined, the first time they are used.
+"""
+import importlib.util
+
+import numpy as np
+
+from .cupy_utils import get_backend
+
+NUMBA_LOADED = importlib.util.find_spec("numba") is not None
+USE_NUMBA = NUMBA_LOADED
+KERNELS = ("q_factor", "calculate_xp_given_xeff", "calculate_xp", "calculate_xeff", "weighted_trapz_rows")
+MIN_SIZE = 10000  # below this, thread start-up costs more than the temporaries
+
+
+def can_use(*arrays) -> bool:
+    """True if the kernels should handle these arguments (float64 ndarrays or scalars)."""
+    if not (USE_NUMBA and get_backend().module is np):
+        return False
+    if not any(type(a) is np.ndarray for a in arrays):
+        return False
+    return all(
+        (type(a) is np.ndarray and a.dtype == np.float64) or isinstance(a, (float, int, np.floating))
+        for a in arrays
+    ) and load()
+
+
+def load() -> bool:
+    """Import numba and define the kernels (once); False if numba cannot be imported."""
+    global NUMBA_LOADED
+    if NUMBA_LOADED and KERNELS[0] not in globals():
+        try:
+            globals().update(_define_kernels())
+        except ImportError:
+            NUMBA_LOADED = False
+    return NUMBA_LOADED
+
+
+def __getattr__(name):
+    if name in KERNELS and load():
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def broadcast_1d(*arrays):
+    """Broadcast to a common 1-D shape (as views), or None if that is not possible/worthwhile."""
+    try:
+        shape = np.broadcast_shapes(*[np.shape(a) for a in arrays])
+    except ValueError:
+        return None
+    if len(shape) != 1 or shape[0] < MIN_SIZE:
+        return None
+    return [np.broadcast_to(np.asarray(a, dtype=np.float64), shape) for a in arrays]
+
+
+def _define_kernels():
+    import numba
+
+    @numba.njit(inline="always")
+    def _max(a, b):
+        # propagates nan like np.maximum
+        return a if (a > b or a != a) else b
+
+    @numba.njit(inline="always")
+    def _q_factor(q):
+        return ((3.0 + 4.0 * q) / (4.0 + 3.0 * q)) * q
+
+    @numba.njit(parallel=True)
+    def q_factor(q):
+        out = np.empty(q.shape[0])
+        for i in numba.prange(q.shape[0]):
+            out[i] = _q_factor(q[i])
+        return out
+
+    @numba.njit(parallel=True)
+    def calculate_xp_given_xeff(xeff, a1, a2, q, cos1, cos2, tan1, tan2):
+        out = np.empty(xeff.shape[0])
+        for i in numba.prange(xeff.shape[0]):
+            case1 = (xeff[i] * (1 + q[i]) - a2[i] * q[i] * cos2[i]) * tan1[i]
+            case2 = (xeff[i] + q[i] * xeff[i] - a1[i] * cos1[i]) * tan2[i] * _q_factor(q[i])
+            out[i] = _max(case1, case2)
+        return out
+
+    @numba.njit(parallel=True)
+    def calculate_xp(a1, a2, q, sin1, sin2):
+        out = np.empty(a1.shape[0])
+        for i in numba.prange(a1.shape[0]):
+            out[i] = _max(a1[i] * sin1[i], a2[i] * sin2[i] * _q_factor(q[i]))
+        return out
+
+    @numba.njit(parallel=True)
+    def calculate_xeff(a1, a2, cos1, cos2, q):
+        out = np.empty(a1.shape[0])
+        for i in numba.prange(a1.shape[0]):
+            out[i] = ((a1[i] * cos1[i]) + (q[i] * a2[i] * cos2[i])) / (1.0 + q[i])
+        return out
+
+    @numba.njit(parallel=True)
+    def weighted_trapz_rows(y, weights, x):
+        """out[i] = trapz(weights * y[i], x)"""
+        out = np.empty(y.shape[0])
+        for i in numba.prange(y.shape[0]):
+            total = 0.0
+            for j in range(y.shape[1] - 1):
+                total += (x[j + 1] - x[j]) * (weights[j] * y[i, j] + weights[j + 1] * y[i, j + 1])
+            out[i] = total / 2.0
+        return out
+
+    return dict(
+        q_factor=q_factor, calculate_xp_given_xeff=calculate_xp_given_xeff, calculate_xp=calculate_xp,
+        calculate_xeff=calculate_xeff, weighted_trapz_rows=weighted_trapz_rows,
+    )
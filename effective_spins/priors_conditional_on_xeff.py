@@ -1,13 +1,34 @@
 """a1, a2, q, theta1, theta2 conditional on xeff"""
-from typing import List, Optional
+from __future__ import annotations
 
-import pandas as pd
-from bilby.core.prior import PriorDict
+from typing import TYPE_CHECKING, Dict, List, Optional
 
-from .cupy_utils import uniform, xp
+import numpy as np
+
+from .cupy_utils import get_backend, to_numpy, trapz, uniform_pdf, xp
+
+if TYPE_CHECKING:
+    from bilby.core.prior import PriorDict
 
 MC_SAMPLES = 100000
 INTEGRATION_POINTS = 10000
+MEMORY_BUDGET = 2 ** 24  # bytes per broadcast (param, xeff, sample) block
+QUADRATURE_POINTS = 128
+SAMPLE_BANK = {}
+SAMPLE_BANK_SIZE = 4  # banks kept at once; the oldest is dropped first
+
+
+def get_traditional_prior() -> "PriorDict":
+    """Uniform priors on a1, a2, q, cos1 and cos2."""
+    from bilby.core.prior import PriorDict, Uniform
+
+    priors = PriorDict()
+    priors["q"] = Uniform(minimum=0, maximum=1)
+    priors["a1"] = Uniform(minimum=0, maximum=1)
+    priors["a2"] = Uniform(minimum=0, maximum=1)
+    priors["cos2"] = Uniform(minimum=-1, maximum=1)
+    priors["cos1"] = Uniform(minimum=-1, maximum=1)
+    return priors
 
 
 def xeff_lim(a1: xp.ndarray, a2: xp.ndarray, q: xp.ndarray, cos2: xp.ndarray):
@@ -17,52 +38,331 @@ def xeff_lim(a1: xp.ndarray, a2: xp.ndarray, q: xp.ndarray, cos2: xp.ndarray):
 
 def p_xeff_given_a1a2qc2(
         param: float, xeff: float,
-        init_a1a2qcos2_prior: PriorDict, param_key: str
-) -> float:
-    """p(xeff|a1,a2,q,c2), O(n)"""
-    s = pd.DataFrame(init_a1a2qcos2_prior.sample(MC_SAMPLES))
+        init_a1a2qcos2_prior: "PriorDict", param_key: str,
+        samples: Optional[Dict[str, xp.ndarray]] = None
+) -> xp.ndarray:
+    """p(xeff|a1,a2,q,c2), O(n), with fresh MC samples unless `samples` (e.g. `get_sample_bank`) are given"""
+    if samples is None:
+        samples = init_a1a2qcos2_prior.sample(MC_SAMPLES)
+    s = {k: xp.asarray(samples[k]) for k in ["a1", "a2", "q", "cos2"]}
     s[param_key] = param
-    xeff_min, xeff_max = xeff_lim(s.a1, s.a2, s.q, s.cos2)
-    return uniform.pdf(xeff, loc=xeff_min, scale=xeff_max - xeff_min)
+    xeff_min, xeff_max = xeff_lim(s["a1"], s["a2"], s["q"], s["cos2"])
+    return uniform_pdf(xeff, loc=xeff_min, scale=xeff_max - xeff_min)
 
 
 def p_param_and_xeff(
         param: float, xeff: float,
-        init_a1a2qcos2_prior: PriorDict, param_key: str
+        init_a1a2qcos2_prior: "PriorDict", param_key: str,
+        samples: Optional[Dict[str, xp.ndarray]] = None
 ) -> float:
     """p(param_key and xeff), O(n^2)"""
-    p_xeff_given_other = xp.asanyarray(
+    p_xeff_given_other = xp.asarray(
         p_xeff_given_a1a2qc2(
-            param, xeff, init_a1a2qcos2_prior, param_key
+            param, xeff, init_a1a2qcos2_prior, param_key, samples
         ))
     p_param = init_a1a2qcos2_prior[param_key].prob(param)
     p_xeff_given_other = xp.nan_to_num(p_xeff_given_other)
     # dont need p_other, only p_param as MC
-    return (1.0 / MC_SAMPLES) * xp.sum(p_xeff_given_other * p_param)
+    return xp.mean(p_xeff_given_other * p_param)
+
+
+def get_sample_bank(
+        init_a1a2qcos2_prior: "PriorDict", num_samples: Optional[int] = None,
+        seed: int = 0, sampler: str = "random"
+) -> Dict[str, xp.ndarray]:
+    """
+    Samples of every prior parameter, drawn once per (prior, num_samples,
+    seed, sampler, backend) and then reused, so all p(param and xeff)
+    evaluations share the same random numbers (smooth, reproducible tables).
+    At most SAMPLE_BANK_SIZE banks are kept (see also `clear_sample_bank`).
+    """
+    num_samples = MC_SAMPLES if num_samples is None else num_samples
+    key = (repr(init_a1a2qcos2_prior), num_samples, seed, sampler, get_backend().name)
+    if key not in SAMPLE_BANK:
+        while len(SAMPLE_BANK) >= max(SAMPLE_BANK_SIZE, 1):
+            SAMPLE_BANK.pop(next(iter(SAMPLE_BANK)))
+        SAMPLE_BANK[key] = draw_samples(init_a1a2qcos2_prior, num_samples, sampler=sampler, seed=seed)
+    return SAMPLE_BANK[key]
+
+
+def clear_sample_bank():
+    """Drop every bank kept by `get_sample_bank`."""
+    SAMPLE_BANK.clear()
+
+
+def p_param_and_xeff_grid(
+        params: xp.ndarray, xeffs: xp.ndarray,
+        init_a1a2qcos2_prior: "PriorDict", param_key: str,
+        samples: Optional[Dict[str, xp.ndarray]] = None,
+        method: str = "mc",
+        return_error: bool = False
+):
+    """
+    p(param_key and xeff) for every (param, xeff) pair, shape (len(params), len(xeffs)).
+
+    One set of MC samples (drawn here if not given, see `draw_samples`) is
+    shared by the whole grid, and the (param, xeff, sample) kernel is
+    evaluated in (param, xeff) blocks sized to MEMORY_BUDGET.
+    method="analytic" uses `p_param_and_xeff_analytic` instead of MC.
+    With return_error, the MC standard error is returned as well.
+    """
+    params = xp.atleast_1d(xp.asarray(params, dtype=float))
+    xeffs = xp.atleast_1d(xp.asarray(xeffs, dtype=float))
+    if method == "analytic":
+        p = p_param_and_xeff_analytic(params, xeffs, init_a1a2qcos2_prior, param_key)
+        return (p, xp.zeros(p.shape)) if return_error else p
+    elif method != "mc":
+        raise ValueError(f"Unknown method {method} for p_param_and_xeff_grid")
+    if samples is None:
+        samples = init_a1a2qcos2_prior.sample(MC_SAMPLES)
+    s = {k: xp.asarray(samples[k])[None, :] for k in ["a1", "a2", "q", "cos2"]}
+    num_samples = s["a1"].shape[-1]
+    p_param = xp.asarray(init_a1a2qcos2_prior[param_key].prob(to_numpy(params)))
+
+    xeff_chunk = max(1, min(len(xeffs), MEMORY_BUDGET // (8 * num_samples)))
+    param_chunk = max(1, MEMORY_BUDGET // (8 * num_samples * xeff_chunk))
+    p_xeff_given_param, p_xeff_given_param_err = [], []
+    for start in range(0, len(params), param_chunk):
+        s[param_key] = params[start:start + param_chunk, None]
+        xeff_min, xeff_max = xeff_lim(s["a1"], s["a2"], s["q"], s["cos2"])
+        p_block, p_block_err = [], []
+        for xeff_start in range(0, len(xeffs), xeff_chunk):
+            p_xeff_given_other = xp.nan_to_num(uniform_pdf(
+                xeffs[None, xeff_start:xeff_start + xeff_chunk, None],
+                loc=xeff_min[:, None, :], scale=(xeff_max - xeff_min)[:, None, :]
+            ))
+            p_block.append(xp.mean(p_xeff_given_other, axis=-1))
+            if return_error:
+                p_block_err.append(xp.std(p_xeff_given_other, axis=-1) / num_samples ** 0.5)
+        p_xeff_given_param.append(xp.concatenate(p_block, axis=1))
+        if return_error:
+            p_xeff_given_param_err.append(xp.concatenate(p_block_err, axis=1))
+    p = xp.concatenate(p_xeff_given_param) * p_param[:, None]
+    if return_error:
+        return p, xp.concatenate(p_xeff_given_param_err) * p_param[:, None]
+    return p
+
+
+def draw_samples(
+        init_a1a2qcos2_prior: "PriorDict", num_samples: int,
+        sampler: str = "random", seed: Optional[int] = None
+) -> Dict[str, xp.ndarray]:
+    """
+    Draw samples from the prior by mapping unit-cube points through each
+    prior's inverse CDF (`Prior.rescale`).
+
+    sampler: "random" (pseudo-random), or scrambled "sobol" or "halton"
+    quasi-random points (use powers of 2 for sobol).
+    """
+    keys = list(init_a1a2qcos2_prior.keys())
+    unit = _unit_sampler(sampler, len(keys), seed)(num_samples)
+    return {k: xp.asarray(init_a1a2qcos2_prior[k].rescale(unit[:, i])) for i, k in enumerate(keys)}
+
+
+def _unit_sampler(sampler: str, dim: int, seed: Optional[int] = None):
+    if sampler == "random":
+        rng = np.random.default_rng(seed)
+        return lambda n: rng.random((n, dim))
+    from scipy.stats import qmc
+
+    if sampler == "sobol":
+        return qmc.Sobol(dim, scramble=True, seed=seed).random
+    elif sampler == "halton":
+        return qmc.Halton(dim, scramble=True, seed=seed).random
+    raise ValueError(f"Unknown sampler {sampler}")
+
+
+def p_param_and_xeff_qmc(
+        params: xp.ndarray, xeffs: xp.ndarray,
+        init_a1a2qcos2_prior: "PriorDict", param_key: str,
+        sampler: str = "sobol", num_samples: int = 2 ** 12, num_replicates: int = 8,
+        tolerance: Optional[float] = None, max_samples: int = 2 ** 20,
+        seed: Optional[int] = None
+):
+    """
+    Randomised quasi-MC p(param_key and xeff) and its standard error, each of
+    shape (len(params), len(xeffs)).
+
+    `num_replicates` independently scrambled sequences give the standard
+    error. Each sequence is extended (doubling the points) until the largest
+    error is below `tolerance` or `max_samples` points per sequence are used.
+    """
+    keys = list(init_a1a2qcos2_prior.keys())
+    seeds = np.random.default_rng(seed).integers(2 ** 32, size=num_replicates)
+    unit_samplers = [_unit_sampler(sampler, len(keys), s) for s in seeds]
+    totals, n_total, n_new = 0, 0, num_samples
+    while True:
+        estimates = []
+        for unit_sampler in unit_samplers:
+            unit = unit_sampler(n_new)
+            samples = {k: init_a1a2qcos2_prior[k].rescale(unit[:, i]) for i, k in enumerate(keys)}
+            estimates.append(p_param_and_xeff_grid(
+                params, xeffs, init_a1a2qcos2_prior, param_key, samples=samples
+            ))
+        totals = totals + n_new * xp.stack(estimates)
+        n_total += n_new
+        replicates = totals / n_total
+        p = xp.mean(replicates, axis=0)
+        p_err = xp.std(replicates, axis=0, ddof=1) / num_replicates ** 0.5
+        if tolerance is None or float(xp.max(p_err)) <= tolerance or 2 * n_total > max_samples:
+            return p, p_err
+        n_new = n_total
+
+
+def p_param_and_xeff_analytic(
+        params: xp.ndarray, xeffs: xp.ndarray,
+        init_a1a2qcos2_prior: "PriorDict", param_key: str,
+        quadrature_points: Optional[int] = QUADRATURE_POINTS
+) -> xp.ndarray:
+    """
+    p(param_key and xeff) without sampling, shape (len(params), len(xeffs)).
+
+    Requires Uniform priors on a1, a2, q and cos2 (a1, a2, q >= 0). With
+    s = xeff (1+q) and c1 ~ U(-1, 1),
+        p(xeff|a1,a2,q,c2) = (1+q)/(2 a1) 1[|s - q a2 c2| <= a1].
+    Two of the nuisance parameters are integrated in closed form (a1 and the
+    one entering q a2 c2 linearly, or a2 and c2 when param_key is a1) and the
+    last one with Gauss-Legendre quadrature. The integrable singularity at
+    a1 = |xeff (1+q) - q a2 c2| = 0 is reported as 0.
+    """
+    bounds = {k: _uniform_bounds(init_a1a2qcos2_prior, k) for k in ["a1", "a2", "q", "cos2"]}
+    if param_key not in bounds:
+        raise ValueError(f"Unknown param_key {param_key}")
+    params = xp.atleast_1d(xp.asarray(params, dtype=float))
+    xeffs = xp.atleast_1d(xp.asarray(xeffs, dtype=float))
+    nodes, weights = np.polynomial.legendre.leggauss(quadrature_points)
+    nodes, weights = xp.asarray(nodes), xp.asarray(weights) / 2
+
+    # ~10 temporaries of shape (params, xeffs, nodes) are alive at once
+    chunk_size = max(1, MEMORY_BUDGET // (80 * len(xeffs) * quadrature_points))
+    p_xeff_given_param = []
+    for start in range(0, len(params), chunk_size):
+        p_xeff_given_other = _p_xeff_given_param_and_node(
+            params[start:start + chunk_size, None, None], xeffs[None, :, None],
+            nodes[None, None, :], bounds, param_key
+        )
+        p_xeff_given_param.append(xp.maximum(xp.sum(weights * p_xeff_given_other, axis=-1), 0))
+    p_param = xp.asarray(init_a1a2qcos2_prior[param_key].prob(to_numpy(params)))
+    return xp.concatenate(p_xeff_given_param) * p_param[:, None]
+
+
+def _p_xeff_given_param_and_node(param, xeff, node, bounds, param_key):
+    """p(xeff|param, x) with x the quadrature parameter at Legendre node `node`."""
+
+    def quadrature_var(key):
+        lo, hi = bounds[key]
+        return lo + (hi - lo) * (node + 1) / 2
+
+    if param_key == "a1":
+        q = quadrature_var("q")
+        s = xeff * (1 + q)
+        a1 = xp.where(param > 0, param, 1)
+        (a2_lo, a2_hi), (c2_lo, c2_hi) = bounds["a2"], bounds["cos2"]
+        region = (
+                _area_below_hyperbola((s + a1) / q, a2_lo, a2_hi, c2_lo, c2_hi)
+                - _area_below_hyperbola((s - a1) / q, a2_lo, a2_hi, c2_lo, c2_hi)
+        )
+        return xp.where(param > 0, (1 + q) / (2 * a1) * region / ((a2_hi - a2_lo) * (c2_hi - c2_lo)), 0)
+
+    if param_key == "a2":
+        a2, q = param, quadrature_var("q")
+        k, linear_key = q * a2, "cos2"
+    elif param_key == "q":
+        a2, q = quadrature_var("a2"), param
+        k, linear_key = q * a2, "cos2"
+    else:
+        c2, q = param, quadrature_var("q")
+        k, linear_key = q * c2, "a2"
+    s = xeff * (1 + q)
+    a1_lo, a1_hi = bounds["a1"]
+    v_lo, v_hi = bounds[linear_key]
+    k_safe = xp.where(k != 0, k, 1)
+    mean_log_kernel = xp.where(
+        k != 0,
+        (_log_kernel_integral(s - k_safe * v_lo, a1_lo, a1_hi)
+         - _log_kernel_integral(s - k_safe * v_hi, a1_lo, a1_hi)) / (k_safe * (v_hi - v_lo)),
+        _log_kernel(s, a1_lo, a1_hi)
+    )
+    return (1 + q) / (2 * (a1_hi - a1_lo)) * mean_log_kernel
+
+
+def _uniform_bounds(init_a1a2qcos2_prior: "PriorDict", key: str):
+    from bilby.core.prior import Uniform
+
+    prior = init_a1a2qcos2_prior[key]
+    if not isinstance(prior, Uniform):
+        raise ValueError(f"Analytic p(xeff) needs a Uniform prior on {key}, not {prior}")
+    if key != "cos2" and prior.minimum < 0:
+        raise ValueError(f"Analytic p(xeff) needs {key} >= 0, not {prior}")
+    return prior.minimum, prior.maximum
+
+
+def _log_kernel(d, a1_lo, a1_hi):
+    """(a1_hi - a1_lo) E_{a1}[1[a1 >= |d|] / a1] = ln(a1_hi / max(|d|, a1_lo)) for |d| < a1_hi."""
+    d = xp.maximum(xp.abs(d), a1_lo)
+    d_safe = xp.where(d > 0, d, a1_hi)
+    return xp.where((d > 0) & (d < a1_hi), xp.log(a1_hi / d_safe), 0)
+
+
+def _log_kernel_integral(t, a1_lo, a1_hi):
+    """int_0^t _log_kernel(d) dd (odd in t)."""
+    abs_t = xp.minimum(xp.abs(t), a1_hi)
+    t_safe = xp.where(abs_t > 0, abs_t, a1_hi)
+    integral = abs_t * (xp.log(a1_hi / t_safe) + 1) - a1_lo
+    if a1_lo > 0:
+        integral = xp.where(abs_t <= a1_lo, abs_t * np.log(a1_hi / a1_lo), integral)
+    return xp.sign(t) * integral
+
+
+def _area_below_hyperbola(t, x_lo, x_hi, y_lo, y_hi):
+    """Area of {(x, y) in [x_lo, x_hi] x [y_lo, y_hi] : x y <= t}, for x_lo >= 0."""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        b1 = xp.clip(xp.nan_to_num(t / y_hi if y_hi != 0 else x_lo + 0 * t), x_lo, x_hi)
+        b2 = xp.clip(xp.nan_to_num(t / y_lo if y_lo != 0 else x_lo + 0 * t), x_lo, x_hi)
+    edges = [x_lo + 0 * t, xp.minimum(b1, b2), xp.maximum(b1, b2), x_hi + 0 * t]
+    area = 0
+    for left, right in zip(edges[:-1], edges[1:]):
+        width = right - left
+        mid = (left + right) / 2
+        y_cut = t / xp.where(mid > 0, mid, 1)
+        ratio = xp.where((left > 0) & (right > 0), right / xp.where(left > 0, left, 1), 1)
+        area = area + xp.where(
+            y_cut >= y_hi, (y_hi - y_lo) * width,
+            xp.where(y_cut <= y_lo, 0, t * xp.log(ratio) - y_lo * width)
+        )
+    return area
 
 
 def p_param_given_xeff(
         param: Optional[float] = 0, xeff: Optional[float] = 0,
-        init_a1a2qcos2_prior: Optional[PriorDict] = None,
+        init_a1a2qcos2_prior: Optional["PriorDict"] = None,
         param_key: Optional[str] = "",
         _p_param_and_xeff: Optional[List] = [],
-        _p_xeff: Optional[List] = []
+        _p_xeff: Optional[List] = [],
+        samples: Optional[Dict[str, xp.ndarray]] = None
 ) -> float:
     """p(param_key|xeff), O(n^3)"""
     if len(_p_xeff) == 0:
         _p_param_and_xeff = p_param_and_xeff(
-            param, xeff, init_a1a2qcos2_prior, param_key)
-        _p_xeff = p_xeff(xeff, init_a1a2qcos2_prior)
+            param, xeff, init_a1a2qcos2_prior, param_key, samples)
+        _p_xeff = p_xeff(xeff, init_a1a2qcos2_prior, samples=samples)
     return _p_param_and_xeff / _p_xeff
 
 
-def p_xeff(xeff: float, init_a1a2qcos2_prior: Optional[PriorDict] = None,
-           a1s=[], p_a1_and_xeff=[]) -> float:
+def p_xeff(xeff, init_a1a2qcos2_prior: Optional["PriorDict"] = None,
+           a1s=[], p_a1_and_xeff=[], method: str = "mc",
+           samples: Optional[Dict[str, xp.ndarray]] = None):
     """
-    p(xeff) = int_{ai \in a} p(a and xeff) da, O(n^3)
+    p(xeff) = int_{ai \\in a} p(a and xeff) da, O(n^3)
+
+    xeff may be an array, in which case p(a1 and xeff) is evaluated on the
+    (a1, xeff) grid with `p_param_and_xeff_grid` (using `method`).
     """
     if len(p_a1_and_xeff) == 0 and len(a1s) == 0:
         a1s = xp.linspace(0, 1, INTEGRATION_POINTS)
-        p_a1_and_xeff = [p_param_and_xeff(a1, xeff, init_a1a2qcos2_prior, 'a1') for a1
-                         in a1s]
-    return xp.trapz(y=p_a1_and_xeff, x=a1s, axis=0)
+        p_a1_and_xeff = p_param_and_xeff_grid(
+            a1s, xeff, init_a1a2qcos2_prior, 'a1', samples=samples, method=method
+        )
+        if xp.ndim(xeff) == 0:
+            p_a1_and_xeff = p_a1_and_xeff[:, 0]
+    return trapz(y=xp.asarray(p_a1_and_xeff), x=xp.asarray(a1s), axis=0)
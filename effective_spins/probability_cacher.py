@@ -1,40 +1,357 @@
+import hashlib
+import json
 import os
+import shutil
+import time
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Sequence
 
-import matplotlib.pyplot as plt
-import pandas as pd
+import numpy as np
 
-from .cupy_utils import xp
+from .cupy_utils import to_numpy, xp
 
-plt.style.use(
-    'https://gist.githubusercontent.com/avivajpeyi/4d9839b1ceb7d3651cbb469bc6b0d69b/raw/4ee4a870126653d542572372ff3eee4e89abcab0/publication.mplstyle')
+if TYPE_CHECKING:
+    import pandas as pd
 
 DATA_KEY = "probabilities"
+COMPLETED_KEY = "completed_chunks"
+MMAP_SUFFIX = ".mmap"
+MMAP_METADATA = "metadata.json"
+CACHE_DIR = os.environ.get(
+    "EFFECTIVE_SPINS_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "effective_spins")
+)
+CACHE_MAX_BYTES = None
+CACHE_MAX_AGE = None  # seconds
+XEFF_ATOL = 1e-9  # xeffs closer than this match a cached slice
+STYLE_FILE = os.path.join(os.path.dirname(__file__), "effective_spins.mplstyle")
+_STYLE_APPLIED = False
 
 
-def store_probabilities(df: pd.DataFrame, fname: str):
+def store_probabilities(df: "pd.DataFrame", fname: str):
     assert ".h5" in fname, f"{fname} is invalid"
     if os.path.isfile(fname):
         print(f"{fname} exsits. Overwritting with newly computed values.")
         os.remove(fname)
+    import pandas as pd
+
     df = clean_df(df)
     store = pd.HDFStore(fname)
     store.append(key=DATA_KEY, value=df, format="t", data_columns=True)
     store.close()
 
 
+def append_probabilities(df: "pd.DataFrame", fname: str, chunk: Optional[int] = None, key: str = ""):
+    """
+    Append rows to the table in `fname` (created if needed). If `chunk` is
+    given it is recorded as completed (for `key`) after the rows are written.
+    """
+    import pandas as pd
+
+    assert ".h5" in fname, f"{fname} is invalid"
+    with pd.HDFStore(fname) as store:
+        store.append(key=DATA_KEY, value=df, format="t", data_columns=True)
+        if chunk is not None:
+            store.append(
+                key=COMPLETED_KEY, value=pd.DataFrame(dict(chunk=[chunk], key=[key])),
+                format="t", min_itemsize={"key": 64}
+            )
+
+
+def completed_chunks(fname: str, key: str = "") -> List[int]:
+    """Chunks recorded by `append_probabilities` in `fname` (raises if they were for another `key`)."""
+    import pandas as pd
+
+    if not os.path.isfile(fname):
+        return []
+    with pd.HDFStore(fname, mode="r") as store:
+        if f"/{COMPLETED_KEY}" not in store.keys():
+            return []
+        completed = store[COMPLETED_KEY]
+    if (completed.key != key).any():
+        raise ValueError(f"{fname} holds chunks computed with different settings.")
+    return sorted(completed.chunk.tolist())
+
+
+def remove_probabilities(fname: str, column: str, low: float, high: float):
+    """Drop the rows with low <= column <= high (e.g. a partially written chunk)."""
+    import pandas as pd
+
+    if not os.path.isfile(fname):
+        return
+    with pd.HDFStore(fname) as store:
+        if f"/{DATA_KEY}" in store.keys():
+            store.remove(DATA_KEY, where=f"({column} >= {low!r}) & ({column} <= {high!r})")
+
+
 def clean_df(df):
     df = df.drop_duplicates(keep='last')
     df = df.fillna(0)
     return df
 
 
-def load_probabilities(fname) -> pd.DataFrame:
+def load_probabilities(fname) -> "pd.DataFrame":
+    import pandas as pd
+
     df: pd.DataFrame = pd.read_hdf(fname, key=DATA_KEY)
     df = clean_df(df)
     return df
 
 
+class XeffIndexedTable:
+    """
+    A p(param|xeff)-style table sorted by xeff, stored as contiguous arrays
+    with one slice [offsets[i], offsets[i+1]) of param and p values per
+    unique xeff, so a lookup is a binary search instead of a table scan.
+    """
+
+    def __init__(self, xeffs: np.ndarray, offsets: np.ndarray, params: np.ndarray, probs: np.ndarray):
+        self.xeffs = xeffs
+        self.offsets = offsets
+        self.params = params
+        self.probs = probs
+
+    @classmethod
+    def from_columns(cls, columns, param_key: str, prob_key: str):
+        """Build from a DataFrame (or any mapping of column name to array)."""
+        xeff = np.asarray(columns["xeff"], dtype=float)
+        param = np.asarray(columns[param_key], dtype=float)
+        probs = np.asarray(columns[prob_key], dtype=float)
+        same_xeff = np.diff(xeff) == 0
+        if not (np.all(np.diff(xeff) >= 0) and np.all(np.diff(param)[same_xeff] >= 0)):
+            order = np.lexsort((param, xeff))
+            xeff, param, probs = xeff[order], param[order], probs[order]
+            same_xeff = np.diff(xeff) == 0
+        starts = np.flatnonzero(np.append(True, ~same_xeff))
+        offsets = np.append(starts, len(xeff))
+        return cls(xeff[starts], offsets, param, probs)
+
+    def __len__(self):
+        return len(self.params)
+
+    def _slice(self, i: int):
+        start, stop = self.offsets[i], self.offsets[i + 1]
+        return self.params[start:stop], self.probs[start:stop]
+
+    def nearest_index(self, xeff: float) -> int:
+        if len(self.xeffs) == 1:
+            return 0
+        i = int(np.clip(np.searchsorted(self.xeffs, xeff), 1, len(self.xeffs) - 1))
+        return i - 1 if abs(xeff - self.xeffs[i - 1]) <= abs(self.xeffs[i] - xeff) else i
+
+    def slice(self, xeff: float, interpolate: bool = False, atol: float = XEFF_ATOL):
+        """
+        (param, p) values of the cached slice at xeff (within `atol`) or, with
+        `interpolate`, linearly interpolated between the two neighbouring
+        xeff slices (on the param values of the lower one). Raises a
+        ValueError outside the cached xeff range, and a KeyError for an
+        uncached xeff unless `interpolate` is set.
+        """
+        if not self.xeffs[0] - atol <= xeff <= self.xeffs[-1] + atol:
+            raise ValueError(f"xeff={xeff} is outside the cached range [{self.xeffs[0]}, {self.xeffs[-1]}]")
+        nearest = self.nearest_index(xeff)
+        if abs(self.xeffs[nearest] - xeff) <= atol:
+            return self._slice(nearest)
+        if not interpolate:
+            raise KeyError(f"No cached slice at xeff={xeff} (nearest: {self.xeffs[nearest]})")
+        i = np.searchsorted(self.xeffs, xeff)
+        (param_lo, p_lo), (param_hi, p_hi) = self._slice(i - 1), self._slice(i)
+        w = (xeff - self.xeffs[i - 1]) / (self.xeffs[i] - self.xeffs[i - 1])
+        p = (1 - w) * p_lo + w * np.interp(param_lo, param_hi, p_hi, left=0, right=0)
+        return param_lo, p
+
+
+    def to_grid(self, num_params: Optional[int] = None):
+        """
+        Resample every xeff slice onto one param grid spanning all slices
+        (with `num_params` points, default: the longest slice), returning
+        (xeffs, params, p) with p of shape (len(xeffs), len(params)).
+        """
+        if num_params is None:
+            num_params = int(np.max(np.diff(self.offsets)))
+        params = np.linspace(np.min(self.params), np.max(self.params), num_params)
+        p = np.zeros((len(self.xeffs), num_params))
+        for i in range(len(self.xeffs)):
+            param_vals, p_vals = self._slice(i)
+            p[i] = np.interp(params, param_vals, p_vals, left=0, right=0)
+        return self.xeffs, params, p
+
+    def to_interpolant(self, num_params: Optional[int] = None):
+        return GridInterpolant(*self.to_grid(num_params))
+
+
+class GridInterpolant:
+    """Bilinear p(param|xeff) over a regular (xeff, param) grid, zero outside it."""
+
+    def __init__(self, xeffs: np.ndarray, params: np.ndarray, probs: np.ndarray):
+        from scipy.interpolate import RegularGridInterpolator
+
+        self.xeffs = xeffs
+        self.params = params
+        self.probs = probs
+        self._interp = RegularGridInterpolator(
+            (xeffs, params), probs, bounds_error=False, fill_value=0
+        )
+
+    def __call__(self, xeff, param) -> np.ndarray:
+        """Evaluate at broadcast (xeff, param) arrays."""
+        xeff, param = np.broadcast_arrays(np.asarray(xeff, dtype=float), np.asarray(param, dtype=float))
+        return self._interp(np.stack([xeff, param], axis=-1))
+
+
+def cache_key(prior, mc_samples: Optional[int] = None, integration_points: Optional[int] = None,
+              **grids) -> str:
+    """
+    Hash of everything that determines a table: the prior repr, the MC
+    settings and the grids (any other settings passed as grids are hashed by repr).
+    """
+    h = hashlib.sha256()
+    h.update(repr(prior).encode())
+    h.update(repr((mc_samples, integration_points)).encode())
+    for name in sorted(grids):
+        h.update(name.encode())
+        if isinstance(grids[name], str):
+            h.update(repr(grids[name]).encode())
+            continue
+        grid = np.ascontiguousarray(to_numpy(xp.asarray(grids[name])), dtype=float)
+        h.update(repr(grid.shape).encode())
+        h.update(grid.tobytes())
+    return h.hexdigest()
+
+
+def cached_probabilities(
+        compute: Callable[[], "pd.DataFrame"], name: str, prior,
+        mc_samples: Optional[int] = None, integration_points: Optional[int] = None,
+        cache_dir: Optional[str] = None, **grids
+) -> "pd.DataFrame":
+    """
+    Load the table `name` computed for these inputs from the cache, or
+    compute(), store and return it. Entries are keyed by `cache_key` and
+    described by a json sidecar; the cache is then trimmed with `evict_cache`.
+    """
+    cache_dir = CACHE_DIR if cache_dir is None else cache_dir
+    key = cache_key(prior, mc_samples, integration_points, **grids)
+    fname = os.path.join(cache_dir, f"{name}_{key}.h5")
+    if os.path.isfile(fname):
+        os.utime(fname)  # mark as recently used
+        return load_probabilities(fname)
+    os.makedirs(cache_dir, exist_ok=True)
+    df = compute()
+    store_probabilities(df, fname)
+    with open(fname.replace(".h5", ".json"), "w") as f:
+        json.dump(dict(
+            name=name, key=key, prior=repr(prior), mc_samples=mc_samples,
+            integration_points=integration_points,
+            grids={k: len(np.atleast_1d(to_numpy(xp.asarray(v)))) for k, v in grids.items()},
+            created=time.time(),
+        ), f, indent=2)
+    df = load_probabilities(fname)
+    evict_cache(cache_dir, max_bytes=CACHE_MAX_BYTES, max_age=CACHE_MAX_AGE, keep=[fname])
+    return df
+
+
+def cached_p_param_and_xeff(params, xeffs, prior, param_key: str, method: str = "mc",
+                            cache_dir: Optional[str] = None) -> "pd.DataFrame":
+    """p(param_key and xeff) on the (params, xeffs) grid, from the cache when possible."""
+    import pandas as pd
+
+    from . import priors_conditional_on_xeff
+
+    def compute():
+        p = priors_conditional_on_xeff.p_param_and_xeff_grid(params, xeffs, prior, param_key, method=method)
+        param_grid, xeff_grid = xp.meshgrid(xp.asarray(params), xp.asarray(xeffs), indexing="ij")
+        return pd.DataFrame({
+            param_key: to_numpy(param_grid.ravel()),
+            "xeff": to_numpy(xeff_grid.ravel()),
+            f"p_{param_key}_and_xeff": to_numpy(p.ravel()),
+        })
+
+    mc_samples = priors_conditional_on_xeff.MC_SAMPLES if method == "mc" else None
+    return cached_probabilities(
+        compute, f"p_{param_key}_and_xeff_{method}", prior,
+        mc_samples=mc_samples, cache_dir=cache_dir, params=params, xeffs=xeffs,
+    )
+
+
+def evict_cache(cache_dir: Optional[str] = None, max_bytes: Optional[int] = None,
+                max_age: Optional[float] = None, keep: Sequence[str] = ()) -> List[str]:
+    """
+    Remove cache entries last used more than `max_age` seconds ago, then the
+    least recently used ones until the cache holds at most `max_bytes`.
+    Tables in `keep` (e.g. the one just written) are never removed.
+    Returns the removed table filenames.
+    """
+    keep = {os.path.abspath(f) for f in keep}
+    cache_dir = CACHE_DIR if cache_dir is None else cache_dir
+    if not os.path.isdir(cache_dir):
+        return []
+    entries = []
+    for f in os.listdir(cache_dir):
+        if f.endswith(".h5"):
+            fname = os.path.join(cache_dir, f)
+            entries.append((os.path.getmtime(fname), os.path.getsize(fname), fname))
+    entries.sort()  # least recently used first
+    total_bytes = sum(size for _, size, _ in entries)
+    removed = []
+    for last_used, size, fname in entries:
+        if os.path.abspath(fname) in keep:
+            continue
+        too_old = max_age is not None and time.time() - last_used > max_age
+        too_big = max_bytes is not None and total_bytes > max_bytes
+        if too_old or too_big:
+            for f in [fname, fname.replace(".h5", ".json")]:
+                if os.path.isfile(f):
+                    os.remove(f)
+            total_bytes -= size
+            removed.append(fname)
+    return removed
+
+
+def store_probabilities_mmap(df: "pd.DataFrame", dirname: str):
+    """
+    Store each column as a contiguous float64 .npy file in `dirname`, with a
+    json sidecar. Duplicates are dropped here, once, and rows are sorted by
+    xeff (then the other columns) so `XeffIndexedTable` can use the mapped
+    arrays without copying.
+    """
+    assert dirname.endswith(MMAP_SUFFIX), f"{dirname} is invalid"
+    df = clean_df(df)
+    columns = list(df.columns)
+    sort_keys = [c for c in columns if c != "xeff"][::-1] + [c for c in columns if c == "xeff"]
+    order = np.lexsort([df[c].to_numpy(dtype=float) for c in sort_keys])
+    tmp_dirname = f"{dirname}.tmp{os.getpid()}"
+    os.makedirs(tmp_dirname, exist_ok=True)
+    for c in columns:
+        np.save(os.path.join(tmp_dirname, f"{c}.npy"), df[c].to_numpy(dtype=np.float64)[order])
+    with open(os.path.join(tmp_dirname, MMAP_METADATA), "w") as f:
+        json.dump(dict(columns=columns, num_rows=len(df), dtype="float64", created=time.time()), f, indent=2)
+    if os.path.isdir(dirname):
+        print(f"{dirname} exsits. Overwritting with newly computed values.")
+        shutil.rmtree(dirname)
+    os.replace(tmp_dirname, dirname)
+
+
+def load_probabilities_mmap(dirname: str) -> Dict[str, np.ndarray]:
+    """{column: read-only memory-mapped array} for a table from `store_probabilities_mmap`."""
+    with open(os.path.join(dirname, MMAP_METADATA)) as f:
+        metadata = json.load(f)
+    return {c: np.load(os.path.join(dirname, f"{c}.npy"), mmap_mode="r") for c in metadata["columns"]}
+
+
+def get_pyplot():
+    """
+    matplotlib.pyplot, imported on first use. The package's style (STYLE_FILE)
+    is applied on the first call only, so later rcParams changes are kept.
+    """
+    global _STYLE_APPLIED
+    import matplotlib.pyplot as plt
+
+    if not _STYLE_APPLIED:
+        plt.style.use(STYLE_FILE)
+        _STYLE_APPLIED = True
+    return plt
+
+
 def plot_probs(x, y, p, xlabel, ylabel, plabel, fname):
+    plt = get_pyplot()
     plt.close('all')
     try:
         p = xp.nan_to_num(p)
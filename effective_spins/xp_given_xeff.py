@@ -1,39 +1,93 @@
-from scipy.interpolate import interp1d
-
-from .cupy_utils import xp
-from .distribution_rules import prod_dist_interp, inv_dist_interp, translate_dist_interp, sum_dist_interp
-from .probability_cacher import load_probabilities
+import os
+
+import numpy as np
+
+from .cupy_utils import to_numpy, xp
+from .density_algebra import Density
+# the *_dist_interp helpers are unused here but stay importable from this module for existing callers
+from .distribution_rules import (
+    TabulatedDensity,
+    adaptive_grid,
+    inv_dist_interp,
+    inverse_distribution,
+    prod_dist_interp,
+    product_distribution,
+    sqrt_1_minus_x2_distribution,
+    sum_dist_interp,
+    sum_distribution,
+    translate_dist_interp,
+    translate_distribution,
+)
+from .probability_cacher import MMAP_SUFFIX, XeffIndexedTable, load_probabilities, load_probabilities_mmap
 
 N = 1000
+# None: N-point uniform grids; otherwise adaptive grids with this relative (L1)
+# interpolation error at every step of the chain
+TOLERANCE = None
+INITIAL_POINTS = 513  # adaptive grids start from (and so never have fewer than) this many points
+PRODUCT_METHOD = "mellin"  # product steps of the chain: O(N log N) (see `product_distribution`)
+
+PARAM_RANGES = [(0.01, 1), (0.01, 1), (0.01, 1), (-1, 1)]  # a1, a2, q, cos2
 
-CACHED_DATA_FOLDER = "studies/data/p_param_given_xeff"
+CACHED_DATA_FOLDER = os.environ.get("EFFECTIVE_SPINS_DATA_DIR", "studies/data/p_param_given_xeff")
 PARAMS = ['a1', 'a2', 'q', 'cos2']
 CACHED_DATA = {}
+CACHED_INTERPOLANTS = {}
 
 
-def get_p_param_given_xeff(xeff=0):
+def load_cached_data():
     if len(CACHED_DATA) == 0:
         for k in PARAMS:
-            param_df = load_probabilities(fname=f"{CACHED_DATA_FOLDER}/p_{k}_given_xeff.h5")
-            CACHED_DATA.update({k: param_df})
-            print(f"Loading cached probs for {k} ({len(param_df)} datapoints)")
-
+            fname = f"{CACHED_DATA_FOLDER}/p_{k}_given_xeff"
+            if os.path.isdir(fname + MMAP_SUFFIX):
+                param_data = load_probabilities_mmap(fname + MMAP_SUFFIX)
+            else:
+                param_data = load_probabilities(fname=fname + ".h5")
+            CACHED_DATA.update({k: XeffIndexedTable.from_columns(param_data, k, f"p_{k}_given_xeff")})
+            print(f"Loading cached probs for {k} ({len(param_data['xeff'])} datapoints)")
+    return CACHED_DATA
+
+
+def get_p_param_given_xeff(xeff=0, interpolate=False):
+    """p(param|xeff) interpolants at a cached xeff (or interpolated between cached xeffs)."""
     p_funcs = dict()
-    for k in CACHED_DATA.keys():
-        df = CACHED_DATA[k].copy()
-        df = df[df['xeff'] == xeff]  # filter data
+    for k, table in load_cached_data().items():
+        param_vals, p_vals = table.slice(xeff, interpolate=interpolate)
         p_funcs.update({
-            f"p_{k}": interp1d(x=df[k], y=df[f'p_{k}_given_xeff'], fill_value=0, bounds_error=False)
+            f"p_{k}": TabulatedDensity(param_vals, p_vals)
         })
     return p_funcs['p_a1'], p_funcs['p_a2'], p_funcs['p_q'], p_funcs['p_cos2']
 
 
-def get_param_grid():
-    a1 = xp.linspace(0.01, 1, N)
-    a2 = xp.linspace(0.01, 1, N)
-    q = xp.linspace(0.01, 1, N)
-    cos2 = xp.linspace(-1, 1, N)
-    return a1, a2, q, cos2
+def get_p_param_given_xeff_interpolants():
+    """
+    {param: f(xeff, param)} 2-D interpolants of p(param|xeff) over the full
+    cached xeff range, built once and evaluated on arrays in one call.
+    """
+    if len(CACHED_INTERPOLANTS) == 0:
+        for k, table in load_cached_data().items():
+            CACHED_INTERPOLANTS.update({k: table.to_interpolant()})
+    return CACHED_INTERPOLANTS
+
+
+def get_grid_and_interp(low, high, pdf):
+    """
+    Tabulate `pdf` (a function of a grid) on [low, high] and interpolate it:
+    on N uniform points, or on an `adaptive_grid` if TOLERANCE is set.
+    """
+    if TOLERANCE is None:
+        z = xp.linspace(low, high, N)
+        p_z = pdf(z)
+    else:
+        z, p_z = adaptive_grid(pdf, low, high, tolerance=TOLERANCE, initial_points=INITIAL_POINTS)
+    return z, TabulatedDensity(z, p_z)
+
+
+def get_param_grid(p_params=None):
+    """Integration grids for a1, a2, q, cos2 (adapted to p_params if TOLERANCE is set)."""
+    if TOLERANCE is None or p_params is None:
+        return tuple(xp.linspace(low, high, N) for low, high in PARAM_RANGES)
+    return tuple(get_grid_and_interp(low, high, p)[0] for (low, high), p in zip(PARAM_RANGES, p_params))
 
 
 def get_p_xp_given_xeff_and_vals(xeff):
@@ -47,13 +101,83 @@ def get_p_xp_given_xeff_and_vals(xeff):
      c = a - b
      d = sqrt(1-c^2)
     """
-    a1, a2, q, cos2 = get_param_grid()
     p_a1, p_a2, p_q, p_cos2 = get_p_param_given_xeff(xeff)
-    d, p_d = get_p_d_and_vals(a2, p_a1, p_a2, p_q, p_cos2, xeff)
+    p_xp = get_xp_given_xeff_expression(p_a1, p_a2, p_q, p_cos2, xeff)
+    return p_xp.tabulate(
+        num_points=N, tolerance=TOLERANCE, initial_points=INITIAL_POINTS, product_method=PRODUCT_METHOD
+    )
 
-    p_xp = prod_dist_interp(z_vals=d, a_vals=a1, pdf_a=p_a1, pdf_b=p_d)
 
-    return p_xp
+def get_p_xp_given_xeff_grid(xeffs, p_param_given_xeff=None):
+    """
+    p(xp|xeff) for many xeffs at once: (xp grid, probs) with probs of shape
+    (len(xeffs), len(xp grid)), row i matching get_p_xp_given_xeff_and_vals(xeffs[i]).
+
+    The p(param|xeff) are tabulated for all xeffs with one call of each
+    {param: f(xeff, param)} interpolant (default:
+    `get_p_param_given_xeff_interpolants`), and every step of the chain then
+    runs once on the stacked (xeff, grid) arrays (see `TabulatedDensity`).
+    xeff(q+1) is evaluated directly from p(q|xeff); rows with xeff = 0 run
+    through the chain without that term (see `get_xp_expression`) and are
+    evaluated on the grid of the other rows.
+    """
+    if p_param_given_xeff is None:
+        p_param_given_xeff = get_p_param_given_xeff_interpolants()
+    xeffs = np.asarray(xeffs, dtype=float)
+    zero = xeffs == 0
+    nonzero = xeffs[~zero]
+    parts = []
+    if len(nonzero) > 0:
+        q_low, q_high = PARAM_RANGES[2]
+
+        def p_xeffqplus1(z):
+            q_vals = to_numpy(z)[None, :] / nonzero[:, None] - 1
+            p_vals = p_param_given_xeff["q"](nonzero[:, None], q_vals) / np.abs(nonzero[:, None])
+            return xp.asarray(np.where((q_vals >= q_low) & (q_vals <= q_high), p_vals, 0.0))
+
+        ends = np.concatenate([nonzero * (1 + q_low), nonzero * (1 + q_high)])
+        xeffqplus1 = Density.from_pdf(p_xeffqplus1, support=(np.min(ends), np.max(ends)))
+        parts.append(get_xp_expression(*_get_param_densities(nonzero, p_param_given_xeff), xeffqplus1).tabulate(
+            num_points=N, tolerance=TOLERANCE, initial_points=INITIAL_POINTS, product_method=PRODUCT_METHOD
+        ))
+    if np.any(zero):
+        parts.append(get_xp_expression(*_get_param_densities(np.zeros(1), p_param_given_xeff)).tabulate(
+            num_points=N, tolerance=TOLERANCE, initial_points=INITIAL_POINTS, product_method=PRODUCT_METHOD
+        ))
+    xps = parts[0].x
+    # rows of the stacked parts in the order of xeffs: the nonzero rows, then the shared xeff = 0 row
+    rows = np.where(zero, len(nonzero), np.cumsum(~zero) - 1)
+    probs = xp.concatenate([part.p if part.x is xps else part(xps) for part in parts], axis=0)
+    return xps, probs[xp.asarray(rows)]
+
+
+def _get_param_densities(xeffs, p_param_given_xeff):
+    """a1, a2, q, cos2 leaves with one row of p(param|xeff) per xeff, on N-point grids over PARAM_RANGES"""
+    return [
+        Density.from_pdf(TabulatedDensity(
+            xp.linspace(low, high, N),
+            xp.asarray(p_param_given_xeff[k](xeffs[:, None], np.linspace(low, high, N)[None, :])),
+        ))
+        for k, (low, high) in zip(PARAMS, PARAM_RANGES)
+    ]
+
+
+def get_xp_given_xeff_expression(p_a1, p_a2, p_q, p_cos2, xeff) -> Density:
+    """xp|xeff as a `Density` expression of the p(param|xeff) pdfs"""
+    a1, a2, q, cos2 = [Density.from_pdf(p, support) for p, support in zip((p_a1, p_a2, p_q, p_cos2), PARAM_RANGES)]
+    return get_xp_expression(a1, a2, q, cos2, None if xeff == 0 else xeff * (q + 1))
+
+
+def get_xp_expression(a1, a2, q, cos2, xeffqplus1=None) -> Density:
+    """
+    xp = a1 sqrt(1 - c^2), c = xeff(q+1)/a1 - a2 q cos2/a1
+
+    xeffqplus1=None drops the first term of c (xeff = 0, where xeff(q+1) is
+    a point mass with no density).
+    """
+    b = a2 * q * cos2 / a1
+    c = -b if xeffqplus1 is None else xeffqplus1 / a1 - b
+    return a1 * c.sqrt_1_minus_x2()
 
 
 def get_p_sqrt_x2_plus_1_dist(z_vals, pdf_a):
@@ -64,61 +188,59 @@ def get_p_sqrt_x2_plus_1_dist(z_vals, pdf_a):
 
     F_{Z}(z) = F_{A}(h(z)) * |dh(z)/dz|
     """
-    h = xp.sqrt(1 - z_vals ** 2)
-    dh_dz = z_vals / h
-    _pdf_z = pdf_a(h) * xp.abs(dh_dz)
-    return interp1d(x=z_vals, y=_pdf_z, fill_value=0, bounds_error=False)
+    return TabulatedDensity(z_vals, sqrt_1_minus_x2_distribution(z_vals, pdf_a))
 
 
 def get_p_xeffqplus1_a1_and_vals(p_q, p_a1, xeff):
-    qplus1 = xp.linspace(1, 2, N)
-    p_qplus1 = translate_dist_interp(z_vals=qplus1, pdf_a=p_q, translate=1)
-
-    xeffqplus1 = xp.linspace(0.1, 2, N)
-    p_xeffqplus1 = translate_dist_interp(z_vals=xeffqplus1, pdf_a=p_qplus1, scale=xeff)
+    qplus1, p_qplus1 = get_grid_and_interp(
+        1, 2, lambda z: translate_distribution(z_vals=z, pdf_a=p_q, translate=1)
+    )
+    xeffqplus1, p_xeffqplus1 = get_grid_and_interp(
+        0.1, 2, lambda z: translate_distribution(z_vals=z, pdf_a=p_qplus1, scale=xeff)
+    )
 
     p_inv_a1 = get_p_inv_a1(p_a1)
 
-    xeffqplus1_a1 = xp.linspace(0.5, 2, N)
-    p_xeffqplus1_a1 = prod_dist_interp(z_vals=xeffqplus1_a1, a_vals=xeffqplus1, pdf_a=p_xeffqplus1, pdf_b=p_inv_a1)
-    return xeffqplus1_a1, p_xeffqplus1_a1
+    return get_grid_and_interp(
+        0.5, 2, lambda z: product_distribution(z_vals=z, a_vals=xeffqplus1, pdf_a=p_xeffqplus1, pdf_b=p_inv_a1)
+    )
 
 
 def get_p_a2qc2_a1_and_vals(a2, p_a1, p_a2, p_q, p_cos2):
     """p of a2qcos2/a1"""
-    a2q = xp.linspace(0.01, 1, N)
-    p_a2q = prod_dist_interp(z_vals=a2q, a_vals=a2, pdf_a=p_a2, pdf_b=p_q)
-
-    a2qc2 = xp.linspace(-1, 1, N)
-    p_a2qc2 = prod_dist_interp(z_vals=a2qc2, a_vals=a2q, pdf_a=p_a2q, pdf_b=p_cos2)
+    a2q, p_a2q = get_grid_and_interp(
+        0.01, 1, lambda z: product_distribution(z_vals=z, a_vals=a2, pdf_a=p_a2, pdf_b=p_q)
+    )
+    a2qc2, p_a2qc2 = get_grid_and_interp(
+        -1, 1, lambda z: product_distribution(z_vals=z, a_vals=a2q, pdf_a=p_a2q, pdf_b=p_cos2)
+    )
 
     p_inv_a1 = get_p_inv_a1(p_a1)
 
-    a2qc2_a1 = xp.linspace(-1, 1, N)
-    p_a2qc2_a1 = prod_dist_interp(z_vals=a2qc2_a1, a_vals=a2qc2, pdf_a=p_a2qc2, pdf_b=p_inv_a1)
-    return a2qc2_a1, p_a2qc2_a1
+    return get_grid_and_interp(
+        -1, 1, lambda z: product_distribution(z_vals=z, a_vals=a2qc2, pdf_a=p_a2qc2, pdf_b=p_inv_a1)
+    )
 
 
 def get_p_c_and_vals(a2, p_a1, p_a2, p_q, p_cos2, xeff):
     """p of xeff(q+1)/a1 + a2qcos2/a1"""
     a, p_a = get_p_xeffqplus1_a1_and_vals(p_q, p_a1, xeff)
     b, p_b = get_p_a2qc2_a1_and_vals(a2, p_a1, p_a2, p_q, p_cos2)
-    neg_b = xp.linspace(-20, 0.01, N)
-    neg_p_b = translate_dist_interp(z_vals=neg_b, pdf_a=p_b, scale=-1)
+    neg_b, neg_p_b = get_grid_and_interp(
+        -20, 0.01, lambda z: translate_distribution(z_vals=z, pdf_a=p_b, scale=-1)
+    )
 
-    c = xp.linspace(0.01, 1, N)
-    p_c = sum_dist_interp(z_vals=c, a_vals=a, pdf_a=p_a, pdf_b=neg_p_b)
-    return c, p_c
+    return get_grid_and_interp(
+        0.01, 1, lambda z: sum_distribution(z_vals=z, a_vals=a, pdf_a=p_a, pdf_b=neg_p_b)
+    )
 
 
 def get_p_d_and_vals(a2, p_a1, p_a2, p_q, p_cos2, xeff):
     """p of sqrt(1-c**2)"""
     c, p_c = get_p_c_and_vals(a2, p_a1, p_a2, p_q, p_cos2, xeff)
-    d = xp.linspace(0.01, 1, N)
-    p_d = get_p_sqrt_x2_plus_1_dist(z_vals=d, pdf_a=p_c)
-    return d, p_d
+    return get_grid_and_interp(0.01, 1, lambda z: sqrt_1_minus_x2_distribution(z_vals=z, pdf_a=p_c))
 
 
 def get_p_inv_a1(p_a1):
-    inv_a1 = xp.linspace(-10, 10, N)
-    return inv_dist_interp(z_vals=inv_a1, pdf_a=p_a1)
+    _, p_inv_a1 = get_grid_and_interp(-10, 10, lambda z: inverse_distribution(z_vals=z, pdf_a=p_a1))
+    return p_inv_a1
@@ -1,44 +1,401 @@
-"""Script to benchmark CuPy vs NumPy"""
+"""
+Benchmark suite for the hot paths, swept over problem sizes and array backends.
+
+    python -m tests.benchmark                       # run everything, record the results
+    python -m tests.benchmark --cases rules --quick # a subset, smallest sizes only
+    python -m tests.benchmark --baseline main       # fail if slower than the run recorded for `main`
+
+Results are stored in RESULTS_FILE as {commit: run}, where a run holds the
+machine description and {"backend/case/size": seconds} (the minimum over
+`--repeat` calls after a warm-up call). `--baseline` is either a commit
+recorded there or a json file of one run (see `--save-baseline`); any case
+slower than the baseline by more than `--threshold` (and by more than
+`--min-time` seconds) is reported, as is any case of this run that failed or
+has no result although the baseline has one; the script then exits with
+status 1. Failed cases also give status 1 without a baseline.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
 import time
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
 
 import numpy as np
-import pandas as pd
-from tqdm import tqdm
 
-from effective_spins import priors_conditional_on_xeff
-from utils import get_traditional_prior
-from effective_spins.cupy_utils import CUPY_LOADED
+from effective_spins import (
+    conversions,
+    distribution_rules,
+    priors_conditional_on_xeff,
+    probability_cacher,
+    xp_given_xeff,
+)
+from effective_spins.cupy_utils import get_backend, set_backend, xp
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_FILE = os.path.join(ROOT, "benchmark_results.json")
+BACKENDS = ["numpy", "numexpr", "cupy", "jax"]
+REPEAT = 5
+MC_XEFF_SAMPLES = 10 ** 4  # p_xeff_mc: samples and a1 points per xeff
+MC_XEFF_POINTS = 1000
+THRESHOLD = 0.25  # allowed fractional slow-down
+MIN_TIME = 1e-3  # seconds; smaller differences are noise
+
+
+class Case(NamedTuple):
+    """`setup(size)` returns the function to time; backend-independent cases run once."""
+    name: str
+    setup: Callable[[int], Callable]
+    sizes: List[int]
+    per_backend: bool = True
+
+
+def _normal_pdf(loc, scale):
+    return lambda x: xp.exp(-0.5 * ((x - loc) / scale) ** 2) / (scale * (2 * np.pi) ** 0.5)
+
+
+def setup_p_param_and_xeff(size):
+    prior = priors_conditional_on_xeff.get_traditional_prior()
+    priors_conditional_on_xeff.MC_SAMPLES = size
+    return lambda: priors_conditional_on_xeff.p_param_and_xeff(
+        param=0.2, xeff=0.2, init_a1a2qcos2_prior=prior, param_key="a1"
+    )
+
+
+def setup_p_xeff(size):
+    prior = priors_conditional_on_xeff.get_traditional_prior()
+    xeffs = xp.linspace(-0.99, 0.99, size)
+    return lambda: priors_conditional_on_xeff.p_xeff(xeffs, prior, method="analytic")
+
+
+def setup_p_xeff_mc(size):
+    prior = priors_conditional_on_xeff.get_traditional_prior()
+    priors_conditional_on_xeff.INTEGRATION_POINTS = MC_XEFF_POINTS
+    samples = priors_conditional_on_xeff.draw_samples(prior, MC_XEFF_SAMPLES, seed=0)
+    xeffs = xp.linspace(-0.99, 0.99, size)
+    return lambda: priors_conditional_on_xeff.p_xeff(xeffs, prior, method="mc", samples=samples)
+
+
+def _conversion_samples(size):
+    s = priors_conditional_on_xeff.draw_samples(priors_conditional_on_xeff.get_traditional_prior(), size, seed=0)
+    s["sin1"] = xp.sqrt(1 - s["cos1"] ** 2)
+    s["sin2"] = xp.sqrt(1 - s["cos2"] ** 2)
+    s["tan1"] = s["sin1"] / s["cos1"]
+    s["tan2"] = s["sin2"] / s["cos2"]
+    return s
+
+
+def setup_calculate_xeff(size):
+    s = _conversion_samples(size)
+    return lambda: conversions.calculate_xeff(a1=s["a1"], a2=s["a2"], cos1=s["cos1"], cos2=s["cos2"], q=s["q"])
+
+
+def setup_calculate_xp(size):
+    s = _conversion_samples(size)
+    return lambda: conversions.calculate_xp(a1=s["a1"], a2=s["a2"], q=s["q"], sin1=s["sin1"], sin2=s["sin2"])
+
+
+def setup_calculate_xp_given_xeff(size):
+    s = _conversion_samples(size)
+    return lambda: conversions.calculate_xp_given_xeff(
+        xeff=0.3, a1=s["a1"], a2=s["a2"], q=s["q"], cos1=s["cos1"], cos2=s["cos2"], tan1=s["tan1"], tan2=s["tan2"]
+    )
+
+
+def _rule_setup(rule, **kwargs):
+    def setup(size):
+        a_vals = xp.linspace(-2, 2, size)
+        z_vals = xp.linspace(-3, 3, size)
+        pdf_a = distribution_rules.TabulatedDensity(a_vals, _normal_pdf(0.2, 0.3)(a_vals))
+        return lambda: rule(z_vals=z_vals, a_vals=a_vals, pdf_a=pdf_a, pdf_b=_normal_pdf(-0.5, 0.4), **kwargs)
+    return setup
+
+
+def setup_mellin_product(size):
+    a_vals = xp.linspace(0.2, 2, size)
+    z_vals = xp.linspace(-2, 2, size)
+    return lambda: distribution_rules.product_distribution(
+        z_vals=z_vals, a_vals=a_vals, pdf_a=_normal_pdf(1, 0.2), pdf_b=_normal_pdf(0.1, 0.5), method="mellin"
+    )
+
+
+def _transform_setup(transform):
+    def setup(size):
+        a_vals = xp.linspace(0.01, 1, 1000)
+        pdf_a = distribution_rules.TabulatedDensity(a_vals, _normal_pdf(0.5, 0.2)(a_vals))
+        z_vals = xp.linspace(-10, 10, size)
+        return lambda: transform(z_vals, pdf_a)
+    return setup
+
+
+def setup_tabulated_density(size):
+    x = xp.linspace(-2, 2, 1000)
+    density = distribution_rules.TabulatedDensity(x, _normal_pdf(0, 0.5)(x))
+    z = xp.linspace(-3, 3, size)
+    return lambda: density(z)
+
+
+def setup_adaptive_grid(size):
+    return lambda: distribution_rules.adaptive_grid(_normal_pdf(0.3, 0.05), -10, 10, tolerance=1 / size)
 
-p = get_traditional_prior()
 
+def _synthetic_p_param_given_xeff():
+    """Smooth stand-in tables for the cached p(param|xeff) data, if it is not on this machine."""
+    if len(xp_given_xeff.CACHED_DATA) > 0 or os.path.isdir(xp_given_xeff.CACHED_DATA_FOLDER):
+        return
+    xeffs = np.linspace(-0.95, 0.95, 39)
+    for k, (low, high) in zip(xp_given_xeff.PARAMS, xp_given_xeff.PARAM_RANGES):
+        params = np.linspace(low, high, 500)
+        xeff_grid, param_grid = np.meshgrid(xeffs, params, indexing="ij")
+        u = (param_grid - low) / (high - low)
+        p = u ** (1.5 + xeff_grid) * (1 - u) ** 1.5
+        p /= np.trapezoid(p, params, axis=-1)[:, None]
+        columns = {"xeff": xeff_grid.ravel(), k: param_grid.ravel(), f"p_{k}_given_xeff": p.ravel()}
+        xp_given_xeff.CACHED_DATA[k] = probability_cacher.XeffIndexedTable.from_columns(
+            columns, k, f"p_{k}_given_xeff"
+        )
 
-def computation(num_samples):
-    """Plots a scatter plot."""
-    priors_conditional_on_xeff.MCMC_SAMPLES = int(num_samples)
-    priors_conditional_on_xeff.p_param_and_xeff(
-        param=0.2,
-        xeff=0.2,
-        init_a1a2qcos2_prior=p,
-        param_key='a1',
+
+def setup_p_xp_given_xeff(size):
+    _synthetic_p_param_given_xeff()
+    xp_given_xeff.N = size
+    return lambda: xp_given_xeff.get_p_xp_given_xeff_and_vals(0.3)
+
+
+def setup_p_xp_given_xeff_grid(size):
+    _synthetic_p_param_given_xeff()
+    xp_given_xeff.N = 500
+    xeffs = np.linspace(-0.9, 0.9, size)
+    return lambda: xp_given_xeff.get_p_xp_given_xeff_grid(xeffs)
+
+
+def _table(size):
+    import pandas as pd
+
+    xeffs = np.repeat(np.linspace(-1, 1, max(size // 1000, 1)), 1000)[:size]
+    a1 = np.tile(np.linspace(0, 1, 1000), max(size // 1000, 1))[:size]
+    return pd.DataFrame(dict(xeff=xeffs, a1=a1, p_a1_and_xeff=np.exp(-a1) * (1 - xeffs ** 2)))
+
+
+def _cacher_setup(fmt, action):
+    def setup(size):
+        df = _table(size)
+        fname = os.path.join(tempfile.mkdtemp(), "p_a1_and_xeff" + (".h5" if fmt == "h5" else probability_cacher.MMAP_SUFFIX))
+        store = probability_cacher.store_probabilities if fmt == "h5" else probability_cacher.store_probabilities_mmap
+        load = probability_cacher.load_probabilities if fmt == "h5" else probability_cacher.load_probabilities_mmap
+        if action == "store":
+            return lambda: store(df, fname)
+        store(df, fname)
+        return lambda: probability_cacher.XeffIndexedTable.from_columns(load(fname), "a1", "p_a1_and_xeff")
+    return setup
+
+
+def setup_import(size):
+    from .test_imports import MODULES, import_in_subprocess
+    return lambda: import_in_subprocess(MODULES)
+
+
+CASES = [
+    Case("p_param_and_xeff", setup_p_param_and_xeff, [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6]),
+    Case("p_xeff_analytic", setup_p_xeff, [1, 10]),
+    Case("p_xeff_mc", setup_p_xeff_mc, [1, 10, 40]),
+    Case("conversions/calculate_xeff", setup_calculate_xeff, [10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7]),
+    Case("conversions/calculate_xp", setup_calculate_xp, [10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7]),
+    Case("conversions/calculate_xp_given_xeff", setup_calculate_xp_given_xeff, [10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7]),
+    Case("rules/sum_batch", _rule_setup(distribution_rules.sum_distribution, method="batch"), [250, 1000, 4000]),
+    Case("rules/sum_fft", _rule_setup(distribution_rules.sum_distribution, method="fft"), [250, 1000, 4000, 16000]),
+    Case("rules/product_batch", _rule_setup(distribution_rules.product_distribution), [250, 1000, 4000]),
+    Case("rules/product_mellin", setup_mellin_product, [250, 1000, 4000]),
+    Case("rules/inverse", _transform_setup(distribution_rules.inverse_distribution), [10 ** 3, 10 ** 5]),
+    Case("rules/translate", _transform_setup(
+        lambda z, pdf: distribution_rules.translate_distribution(z, pdf, scale=2.0, translate=1.0)
+    ), [10 ** 3, 10 ** 5]),
+    Case("rules/sqrt_1_minus_x2", _transform_setup(distribution_rules.sqrt_1_minus_x2_distribution), [10 ** 3, 10 ** 5]),
+    Case("rules/tabulated_density", setup_tabulated_density, [10 ** 3, 10 ** 5, 10 ** 7]),
+    Case("rules/adaptive_grid", setup_adaptive_grid, [10 ** 3, 10 ** 4]),
+    Case("xp_given_xeff", setup_p_xp_given_xeff, [250, 1000]),
+    Case("xp_given_xeff_grid", setup_p_xp_given_xeff_grid, [10, 40]),
+    Case("cacher/store_h5", _cacher_setup("h5", "store"), [10 ** 4, 10 ** 5], per_backend=False),
+    Case("cacher/load_h5", _cacher_setup("h5", "load"), [10 ** 4, 10 ** 5], per_backend=False),
+    Case("cacher/store_mmap", _cacher_setup("mmap", "store"), [10 ** 4, 10 ** 6], per_backend=False),
+    Case("cacher/load_mmap", _cacher_setup("mmap", "load"), [10 ** 4, 10 ** 6], per_backend=False),
+    Case("import", setup_import, [1], per_backend=False),
+]
+
+
+def _block(result):
+    """Wait for asynchronous (cupy, jax) results before the clock is read."""
+    if get_backend().name == "cupy":
+        get_backend().module.cuda.Device().synchronize()
+    elif hasattr(result, "block_until_ready"):
+        result.block_until_ready()
+
+
+def time_call(func: Callable, repeat: int = REPEAT) -> float:
+    """Minimum wall time of `repeat` calls, after one warm-up call (jit compilation, caches)."""
+    _block(func())
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        _block(func())
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def _sizes(case: Case, quick: bool) -> List[int]:
+    return case.sizes[:2] if quick else case.sizes
+
+
+def planned_keys(cases: List[Case], backends: List[str], quick: bool = False) -> List[str]:
+    """The keys `run` records if every case succeeds on every backend."""
+    return [
+        f"{label}/{case.name}/{size}"
+        for case in cases
+        for label in (backends if case.per_backend else ["any"])
+        for size in _sizes(case, quick)
+    ]
+
+
+def run(cases: List[Case], backends: List[str], repeat: int = REPEAT,
+        quick: bool = False) -> Tuple[Dict[str, float], List[str]]:
+    """
+    ({"backend/case/size": seconds}, keys of the cases that raised);
+    backend-independent cases are keyed "any/case/size".
+    """
+    results, failed = {}, []
+    _run_cases([c for c in cases if not c.per_backend], "any", repeat, quick, results, failed)
+    for backend in backends:
+        try:
+            set_backend(backend)
+        except ImportError:
+            print(f"Skipping the {backend} backend (not installed)")
+            continue
+        _run_cases([c for c in cases if c.per_backend], backend, repeat, quick, results, failed)
+    return results, failed
+
+
+def _run_cases(cases: List[Case], label: str, repeat: int, quick: bool, results: Dict[str, float],
+               failed: List[str]):
+    settings = (
+        priors_conditional_on_xeff.MC_SAMPLES, priors_conditional_on_xeff.INTEGRATION_POINTS, xp_given_xeff.N
     )
+    for case in cases:
+        for size in _sizes(case, quick):
+            key = f"{label}/{case.name}/{size}"
+            try:
+                results[key] = time_call(case.setup(size), repeat)
+                print(f"{key:<55} {results[key]:.4g} s")
+            except Exception as e:
+                print(f"{key:<55} FAILED: {e!r}")
+                failed.append(key)
+            finally:
+                (priors_conditional_on_xeff.MC_SAMPLES, priors_conditional_on_xeff.INTEGRATION_POINTS,
+                 xp_given_xeff.N) = settings
+
+
+def git_commit() -> str:
+    """The checked-out commit, with "-dirty" if tracked files have changed."""
+    def git(*args):
+        return subprocess.run(["git", *args], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    commit = git("rev-parse", "--short", "HEAD") or "unknown"
+    return commit + ("-dirty" if git("status", "--porcelain", "--untracked-files=no") else "")
+
+
+def machine() -> Dict[str, str]:
+    return dict(
+        platform=platform.platform(), processor=platform.processor(), python=platform.python_version(),
+        numpy=np.__version__, cpus=str(os.cpu_count()),
+    )
+
+
+def load_baseline(baseline: str, results_file: str) -> Dict[str, float]:
+    """The results of a commit recorded in `results_file`, or of a json file of one run."""
+    if os.path.isfile(baseline):
+        with open(baseline) as f:
+            return json.load(f)["results"]
+    with open(results_file) as f:
+        runs = json.load(f)
+    if baseline not in runs:
+        raise ValueError(f"No run for {baseline} in {results_file} (runs: {sorted(runs)})")
+    return runs[baseline]["results"]
+
+
+def compare(results: Dict[str, float], baseline: Dict[str, float], threshold: float = THRESHOLD,
+            min_time: float = MIN_TIME, expected: Optional[List[str]] = None) -> List[str]:
+    """
+    Print the speed-up of every case in both runs; return the keys that
+    regressed, including baseline cases in `expected` (default: all of them)
+    that have no result in this run (failed, or a backend that is missing).
+    """
+    regressions = []
+    expected = set(baseline) if expected is None else set(baseline) & set(expected)
+    for key in sorted(expected | (set(results) & set(baseline))):
+        old = baseline[key]
+        if key not in results:
+            print(f"{key:<55} {old:.4g} s -> no result  REGRESSION")
+            regressions.append(key)
+            continue
+        new = results[key]
+        slower = new > old * (1 + threshold) and new - old > min_time
+        print(f"{key:<55} {old:.4g} s -> {new:.4g} s ({old / new:.2f}x){'  REGRESSION' if slower else ''}")
+        if slower:
+            regressions.append(key)
+    return regressions
+
 
+def main(args: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cases", nargs="*", default=[], help="only cases whose name contains one of these")
+    parser.add_argument("--backends", nargs="*", default=BACKENDS)
+    parser.add_argument("--repeat", type=int, default=REPEAT)
+    parser.add_argument("--quick", action="store_true", help="only the two smallest sizes of each case")
+    parser.add_argument("--results-file", default=RESULTS_FILE)
+    parser.add_argument("--baseline", help="commit in the results file, or a json file of one run")
+    parser.add_argument("--save-baseline", help="also write this run to this json file")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD)
+    parser.add_argument("--min-time", type=float, default=MIN_TIME)
+    args = parser.parse_args(args)
 
-def benchmark():
-    num_samp = [1e3, 1e4, 1e5, 1e6, 1e7]
-    times = np.zeros(len(num_samp))
-    for i in tqdm(range(len(num_samp))):
-        start = time.time()
-        computation(num_samp[i])
-        times[i] = time.time() - start
-    return pd.DataFrame(dict(n=num_samp, t=times))
+    cases = [c for c in CASES if not args.cases or any(name in c.name for name in args.cases)]
+    commit = git_commit()
+    baseline = None if args.baseline is None else load_baseline(args.baseline, args.results_file)
+    print(f"Benchmarking {commit} ({len(cases)} cases, backends: {', '.join(args.backends)})")
+    backend = get_backend().name
+    results, failed = run(cases, args.backends, repeat=args.repeat, quick=args.quick)
+    set_backend(backend)
 
+    run_record = dict(commit=commit, created=time.time(), machine=machine(), results=results)
+    runs = {}
+    if os.path.isfile(args.results_file):
+        with open(args.results_file) as f:
+            runs = json.load(f)
+    runs.setdefault(commit, dict(results={}))
+    run_record["results"] = {**runs[commit]["results"], **results}
+    runs[commit] = run_record
+    with open(args.results_file, "w") as f:
+        json.dump(runs, f, indent=2)
+    print(f"Saved results for {commit} to {args.results_file}")
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(run_record, f, indent=2)
 
-def main():
-    if CUPY_LOADED:
-        print("Using CuPy")
-    else:
-        print("Using NumPy")
-    print(benchmark())
+    regressions = []
+    if baseline is not None:
+        regressions = compare(
+            results, baseline, threshold=args.threshold, min_time=args.min_time,
+            expected=planned_keys(cases, args.backends, args.quick)
+        )
+        if regressions:
+            print(f"{len(regressions)} regression(s) against {args.baseline}: {', '.join(regressions)}")
+        else:
+            print(f"No regressions against {args.baseline}")
+    if failed:
+        print(f"{len(failed)} case(s) failed: {', '.join(failed)}")
+    if regressions or failed:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -3,9 +3,12 @@ import unittest
 
 import numpy as np
 import pandas as pd
+from bilby.core.prior import Uniform
 
 from effective_spins import distribution_rules
+from effective_spins import priors_conditional_on_xeff
 from effective_spins import probability_cacher
+from . import utils
 from .utils import uniform_distribution
 
 
@@ -33,6 +36,179 @@ class TestCaching(unittest.TestCase):
         probability_cacher.store_probabilities(df, fname)
         probability_cacher.load_probabilities(fname)
 
+    def test_content_addressed_cache(self):
+        prior = utils.get_traditional_prior()
+        params, xeffs = np.linspace(0.1, 0.9, 4), np.array([-0.2, 0.3])
+        calls = []
+
+        def compute():
+            calls.append(1)
+            return pd.DataFrame(dict(a1=params, p=params ** 2))
+
+        kwargs = dict(name="p_test", mc_samples=10, cache_dir=self.outdir, params=params, xeffs=xeffs)
+        df = probability_cacher.cached_probabilities(compute, prior=prior, **kwargs)
+        cached_df = probability_cacher.cached_probabilities(compute, prior=prior, **kwargs)
+        self.assertEqual(len(calls), 1)
+        pd.testing.assert_frame_equal(df, cached_df)
+
+        prior["a1"] = Uniform(minimum=0, maximum=0.5)
+        probability_cacher.cached_probabilities(compute, prior=prior, **kwargs)
+        self.assertEqual(len(calls), 2)
+        kwargs["params"] = params[:-1]
+        probability_cacher.cached_probabilities(compute, prior=prior, **kwargs)
+        self.assertEqual(len(calls), 3)
+
+        self.assertEqual(len(probability_cacher.evict_cache(self.outdir, max_age=3600)), 0)
+        removed = probability_cacher.evict_cache(self.outdir, max_bytes=0)
+        self.assertEqual(len(removed), 3)
+        self.assertEqual(os.listdir(self.outdir), [])
+
+        df = probability_cacher.cached_p_param_and_xeff(
+            params, xeffs, utils.get_traditional_prior(), "a1", method="analytic", cache_dir=self.outdir
+        )
+        self.assertEqual(list(df.columns), ["a1", "xeff", "p_a1_and_xeff"])
+        self.assertEqual(len(df), len(params) * len(xeffs))
+
+    def test_cache_smaller_than_one_table(self):
+        params = np.linspace(0.1, 0.9, 4)
+        max_bytes = probability_cacher.CACHE_MAX_BYTES
+        probability_cacher.CACHE_MAX_BYTES = 1000
+        try:
+            for i in range(2):
+                df = probability_cacher.cached_probabilities(
+                    lambda: pd.DataFrame(dict(a1=params, p=params * i)), name="p_test",
+                    prior=utils.get_traditional_prior(), mc_samples=i, cache_dir=self.outdir, params=params,
+                )
+                np.testing.assert_array_equal(df.p, params * i)
+        finally:
+            probability_cacher.CACHE_MAX_BYTES = max_bytes
+        # only the newest table is left
+        self.assertEqual(len([f for f in os.listdir(self.outdir) if f.endswith(".h5")]), 1)
+
+    def test_mmap_caching(self):
+        xeffs, a1 = np.array([0.3, -0.1, 0.1]), np.linspace(0, 1, 5)
+        df = pd.DataFrame(dict(
+            xeff=np.repeat(xeffs, len(a1)),
+            a1=np.tile(a1, len(xeffs)),
+            p_a1_given_xeff=np.repeat(xeffs, len(a1)) * np.tile(a1, len(xeffs)),
+        ))
+        df = pd.concat([df, df.iloc[:4]])
+        fname = f"{self.outdir}/dat.mmap"
+        probability_cacher.store_probabilities_mmap(df, fname)
+        probability_cacher.store_probabilities_mmap(df, fname)
+        data = probability_cacher.load_probabilities_mmap(fname)
+        self.assertEqual(list(data.keys()), list(df.columns))
+        self.assertIsInstance(data["xeff"], np.memmap)
+        self.assertEqual(len(data["xeff"]), 15)
+        self.assertTrue(np.all(np.diff(data["xeff"]) >= 0))
+
+        table = probability_cacher.XeffIndexedTable.from_columns(data, "a1", "p_a1_given_xeff")
+        self.assertTrue(np.shares_memory(table.probs, data["p_a1_given_xeff"]))
+        param, p = table.slice(0.3)
+        np.testing.assert_allclose(p, 0.3 * param)
+
+    def test_xeff_indexed_table(self):
+        xeffs, a1 = np.array([0.3, -0.1, 0.1]), np.linspace(0, 1, 5)
+        df = pd.DataFrame(dict(
+            xeff=np.repeat(xeffs, len(a1)),
+            a1=np.tile(a1, len(xeffs)),
+            p_a1_given_xeff=np.repeat(xeffs, len(a1)) + np.tile(a1, len(xeffs)),
+        )).sample(frac=1, random_state=0)
+        table = probability_cacher.XeffIndexedTable.from_columns(df, "a1", "p_a1_given_xeff")
+        np.testing.assert_array_equal(table.xeffs, np.sort(xeffs))
+        self.assertEqual(len(table), len(df))
+
+        param, p = table.slice(0.1)
+        np.testing.assert_array_equal(param, a1)
+        np.testing.assert_allclose(p, 0.1 + a1)
+        _, p = table.slice(0.1 + 1e-12)
+        np.testing.assert_allclose(p, 0.1 + a1)
+        with self.assertRaises(KeyError):
+            table.slice(0.12)
+        _, p = table.slice(0.2, interpolate=True)
+        np.testing.assert_allclose(p, 0.2 + a1)
+        for xeff in [5, -0.2]:
+            for interpolate in [False, True]:
+                with self.assertRaises(ValueError):
+                    table.slice(xeff, interpolate=interpolate)
+
+    def test_grid_interpolant(self):
+        xeffs = np.linspace(-0.5, 0.5, 11)
+        df = pd.concat([
+            pd.DataFrame(dict(xeff=xeff, q=q, p_q_given_xeff=2 * xeff + q))
+            for xeff, q in zip(xeffs, [np.linspace(0, 1, 21 + i) for i in range(len(xeffs))])
+        ])
+        table = probability_cacher.XeffIndexedTable.from_columns(df, "q", "p_q_given_xeff")
+        interpolant = table.to_interpolant()
+        xeff_vals = np.random.uniform(-0.5, 0.5, 1000)
+        q_vals = np.random.uniform(0, 1, 1000)
+        np.testing.assert_allclose(interpolant(xeff_vals, q_vals), 2 * xeff_vals + q_vals)
+        self.assertEqual(interpolant(0.1, np.linspace(0, 1, 7)).shape, (7,))
+        self.assertEqual(interpolant(2, 0.5), 0)
+
+    def test_resumable_p_param_and_xeff(self):
+        from effective_spins.computers import compute_and_store_p_param_and_xeff as computer
+
+        params, xeffs = computer.get_grid("q", 8, 11)
+        fname = f"{self.outdir}/p_q_and_xeff.h5"
+        kwargs = dict(param_key="q", fname=fname, params=params, xeffs=xeffs, chunk_size=3, method="analytic")
+        key = computer.get_run_key(utils.get_traditional_prior(), params, xeffs, 3, "analytic")
+        computer.compute_and_store_p_param_and_xeff(**kwargs, chunks=[0, 2])
+        self.assertEqual(probability_cacher.completed_chunks(fname, key), [0, 2])
+        # a chunk interrupted before it was marked as completed
+        partial = pd.DataFrame(dict(q=params, xeff=xeffs[3], p_q_and_xeff=-1.0))
+        probability_cacher.append_probabilities(partial, fname)
+
+        computer.compute_and_store_p_param_and_xeff(**kwargs)
+        self.assertEqual(probability_cacher.completed_chunks(fname, key), [0, 1, 2, 3])
+        df = probability_cacher.load_probabilities(fname).sort_values(["xeff", "q"])
+        self.assertEqual(len(df), len(params) * len(xeffs))
+        expected = priors_conditional_on_xeff.p_param_and_xeff_grid(params, xeffs, utils.get_traditional_prior(), "q",
+                                                                    method="analytic")
+        np.testing.assert_allclose(df.p_q_and_xeff, expected.T.ravel())
+
+        with self.assertRaises(ValueError):
+            computer.compute_and_store_p_param_and_xeff(**dict(kwargs, chunk_size=4))
+
+    def test_resume_with_unsorted_xeffs(self):
+        from effective_spins.computers import compute_and_store_p_param_and_xeff as computer
+
+        params, xeffs = computer.get_grid("q", 5, 9)
+        xeffs = xeffs[::-1]
+        fname = f"{self.outdir}/p_q_and_xeff.h5"
+        kwargs = dict(param_key="q", fname=fname, params=params, xeffs=xeffs, chunk_size=3, method="analytic")
+        computer.compute_and_store_p_param_and_xeff(**kwargs, chunks=[0])
+        partial = pd.DataFrame(dict(q=params, xeff=np.sort(xeffs)[4], p_q_and_xeff=-1.0))
+        probability_cacher.append_probabilities(partial, fname)
+        computer.compute_and_store_p_param_and_xeff(**kwargs)
+        df = probability_cacher.load_probabilities(fname)
+        self.assertEqual(len(df), len(params) * len(xeffs))
+        self.assertTrue(np.all(df.p_q_and_xeff >= 0))
+
+    def test_sharded_p_param_and_xeff(self):
+        from effective_spins.computers import compute_and_store_p_param_and_xeff as computer
+        from effective_spins.computers import merge_shards
+
+        params, xeffs = computer.get_grid("cos2", 6, 10)
+        fname = f"{self.outdir}/p_cos2_and_xeff.h5"
+        num_shards = 3
+        chunk_ids = list(range(len(computer.split_into_chunks(xeffs, 2))))
+        for shard in range(num_shards):
+            computer.compute_and_store_p_param_and_xeff(
+                "cos2", merge_shards.shard_fname(fname, shard, num_shards), params, xeffs, chunk_size=2,
+                method="analytic", chunks=merge_shards.shard_items(chunk_ids, shard, num_shards)
+            )
+        with self.assertRaises(FileNotFoundError):
+            merge_shards.merge_shards(fname, num_shards + 1)
+        merge_shards.merge_shards(fname, num_shards)
+
+        df = probability_cacher.load_probabilities(fname)
+        self.assertEqual(len(df), len(params) * len(xeffs))
+        self.assertTrue(np.all(np.diff(df.xeff) >= 0))
+        expected = priors_conditional_on_xeff.p_param_and_xeff_grid(params, xeffs, utils.get_traditional_prior(),
+                                                                    "cos2", method="analytic")
+        np.testing.assert_allclose(df.p_cos2_and_xeff, expected.T.ravel())
+
     def test_plotting(self):
         a = np.linspace(0, 1, 100)
         b = np.linspace(0, 1, 100)
@@ -0,0 +1,92 @@
+import importlib.util
+import os
+import subprocess
+import sys
+import unittest
+
+import numpy as np
+from scipy.stats import uniform
+
+from effective_spins import cupy_utils, distribution_rules, priors_conditional_on_xeff
+
+
+class TestBackends(unittest.TestCase):
+    def setUp(self):
+        self.original_backend = cupy_utils.get_backend().name
+
+    def tearDown(self):
+        cupy_utils.set_backend(self.original_backend)
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            cupy_utils.set_backend("not-a-backend")
+
+    def test_env_var_selects_backend(self):
+        env = dict(os.environ, **{cupy_utils.BACKEND_ENV_VAR: "numexpr"})
+        out = subprocess.run(
+            [sys.executable, "-c", "from effective_spins.cupy_utils import get_backend; print(get_backend().name)"],
+            env=env, capture_output=True, text=True, check=True
+        )
+        self.assertEqual(out.stdout.strip(), "numexpr")
+
+    def test_import_does_not_choose_backend(self):
+        code = (
+            "import effective_spins.distribution_rules, effective_spins.density_estimation\n"
+            "import effective_spins.priors_conditional_on_xeff, effective_spins.joint_xp_xeff_prior\n"
+            "import effective_spins.xp_given_xeff\n"
+            "from effective_spins import cupy_utils\n"
+            "assert cupy_utils._ACTIVE_BACKEND == [], cupy_utils._ACTIVE_BACKEND\n"
+            "print(cupy_utils.set_backend('numexpr').name, cupy_utils.xp.__name__)"
+        )
+        out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+        self.assertEqual(out.stdout.strip(), "numexpr numpy")
+
+    def test_backends_agree(self):
+        x = np.random.uniform(-2, 2, (50, 1))
+        loc = np.random.uniform(-1, 1, 40)
+        scale = np.random.uniform(-0.5, 2, 40)
+        expected_pdf = uniform.pdf(x, loc=loc, scale=scale)
+        expected_integral = np.trapezoid(np.sin(x[:, 0] * loc[:, None]), x=x[:, 0], axis=-1)
+        for name in ["numpy", "numexpr", "jax"]:
+            try:
+                cupy_utils.set_backend(name)
+            except ImportError:
+                continue
+            xp = cupy_utils.xp
+            self.assertIs(xp.linspace, cupy_utils.get_backend().module.linspace)
+            pdf = cupy_utils.uniform_pdf(xp.asarray(x), xp.asarray(loc), xp.asarray(scale))
+            np.testing.assert_array_equal(cupy_utils.to_numpy(pdf), expected_pdf)
+            integral = cupy_utils.trapz(xp.sin(xp.asarray(x[:, 0]) * xp.asarray(loc)[:, None]), x=xp.asarray(x[:, 0]))
+            np.testing.assert_allclose(cupy_utils.to_numpy(integral), expected_integral)
+
+    @unittest.skipIf(importlib.util.find_spec("jax") is None, "jax is not installed")
+    def test_rules_on_jax(self):
+        def run():
+            xp = cupy_utils.xp
+            pdf_a = lambda x: xp.exp(-x ** 2 / 2) / np.sqrt(2 * np.pi)
+            pdf_b = lambda x: cupy_utils.uniform_pdf(x, 0.0, 1.0)
+            a_vals, z_vals = xp.asarray(np.linspace(-3, 3, 200)), xp.asarray(np.linspace(-4, 4, 101))
+            out = [distribution_rules.adaptive_grid(pdf_a, -5, 5, tolerance=1e-4)[1]]
+            for rule in [distribution_rules.sum_distribution, distribution_rules.product_distribution]:
+                for method in ["loop", "batch"]:
+                    out.append(rule(z_vals, a_vals, pdf_a, pdf_b, method=method))
+            return [cupy_utils.to_numpy(p) for p in out]
+
+        cupy_utils.set_backend("numpy")
+        expected = run()
+        cupy_utils.set_backend("jax")
+        for p, p_expected in zip(run(), expected):
+            np.testing.assert_allclose(p, p_expected, rtol=1e-10, atol=1e-12)
+
+    def test_mc_kernel_on_numexpr(self):
+        prior = priors_conditional_on_xeff.get_traditional_prior()
+        samples = priors_conditional_on_xeff.draw_samples(prior, 5000, seed=0)
+        params = np.linspace(0.1, 0.9, 4)
+        expected = priors_conditional_on_xeff.p_param_and_xeff_grid(params, [0.1, 0.4], prior, "q", samples=samples)
+        cupy_utils.set_backend("numexpr")
+        p = priors_conditional_on_xeff.p_param_and_xeff_grid(params, [0.1, 0.4], prior, "q", samples=samples)
+        np.testing.assert_allclose(p, expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,120 @@
+import unittest
+
+import numpy as np
+from scipy.stats import beta, uniform
+
+from effective_spins import density_algebra, xp_given_xeff
+from effective_spins.density_algebra import Density
+
+
+class TestDensityAlgebra(unittest.TestCase):
+    def setUp(self):
+        self.dists = dict(a1=uniform(0.1, 0.9), a2=beta(2, 2), q=beta(3, 1.5), cos2=uniform(-1, 2))
+        supports = dict(a1=(0.1, 1), a2=(0, 1), q=(0, 1), cos2=(-1, 1))
+        self.vars = {k: Density.from_pdf(d.pdf, supports[k]) for k, d in self.dists.items()}
+
+    def test_supports(self):
+        a1, a2, q, cos2 = self.vars.values()
+        self.assertEqual((q + 1).support, (1, 2))
+        self.assertEqual((-0.5 * q).support, (-0.5, 0))
+        self.assertEqual((a2 * cos2).support, (-1, 1))
+        self.assertEqual((1 / a1).support, (1, density_algebra.INVERSE_LIMIT))
+        self.assertEqual((1 / cos2).support, (-density_algebra.INVERSE_LIMIT, density_algebra.INVERSE_LIMIT))
+        self.assertEqual((q - cos2).support, (-1, 2))
+        self.assertEqual((cos2 * 0.5).sqrt_1_minus_x2().support, (np.sqrt(0.75), 1))
+        with self.assertRaises(ValueError):
+            (-1 - q).sqrt_1_minus_x2()
+        self.assertEqual((q - cos2).restrict(-0.5, 5).support, (-0.5, 2))
+        # sqrt_1_minus_x2 only reads its argument on [0, 1], so that is all that is tabulated
+        c = 0.3 * (q + 1) / a1 - a2 * q * cos2 / a1
+        self.assertEqual(c.sqrt_1_minus_x2().args[0].support, (0, 1))
+        self.assertNotEqual(c.restrict(0, 1).key, c.key)
+        with self.assertRaises(ValueError):
+            q * 0
+
+    def test_shared_subexpressions(self):
+        a1, a2, q, cos2 = self.vars.values()
+        self.assertEqual((a2 / a1).key, (a2 / a1).key)
+        self.assertNotEqual((a2 / a1).key, (a1 / a2).key)
+        c = 0.3 * (q + 1) / a1 - a2 * q * cos2 / a1
+        cache = {}
+        c.tabulate(cache=cache)
+        # a1, a2, q, cos2, q+1, 0.3(q+1), 1/a1, 0.3(q+1)/a1, a2 q, a2 q cos2, a2 q cos2/a1, its negative, c
+        self.assertEqual(len(cache), 13)
+        self.assertIs(c.tabulate(cache=cache), cache[c.key])
+
+    def test_sum_of_uniforms(self):
+        a = Density.from_pdf(uniform(0, 1).pdf, (0, 1))
+        z = np.linspace(0, 2, 201)
+        np.testing.assert_allclose((a + a).tabulate()(z), 1 - np.abs(z - 1), atol=5e-3)
+        np.testing.assert_allclose((2 * a - 1).tabulate()(z - 1), np.where(np.abs(z - 1) <= 1, 0.5, 0), atol=1e-12)
+
+    def test_restricted_support_matches_mc(self):
+        xeff = 0.3
+        a1, a2, q, cos2 = self.vars.values()
+        # c spans about [-9.7, 16]; all 100 points go to the part in [0, 1]
+        p_c = (xeff * (q + 1) / a1 - a2 * q * cos2 / a1).restrict(0, 1).tabulate(num_points=100)
+        self.assertEqual((float(p_c.x[0]), float(p_c.x[-1])), (0, 1))
+
+        rng = np.random.default_rng(1)
+        n = 2 * 10 ** 6
+        draw = lambda k: self.dists[k].rvs(n, random_state=rng)
+        c = xeff * (draw("q") + 1) / draw("a1") - draw("a2") * draw("q") * draw("cos2") / draw("a1")
+        counts, edges = np.histogram(c, bins=50, range=(0, 1))
+        width = edges[1] - edges[0]
+        centres = (edges[1:] + edges[:-1]) / 2
+        self.assertLess(np.sum(np.abs(p_c(centres) - counts / n / width)) * width, 1.5e-2)
+
+    def test_xp_given_xeff_matches_mc(self):
+        xeff = 0.3
+        p = [self.dists[k].pdf for k in ["a1", "a2", "q", "cos2"]]
+        xp_given_xeff.PARAM_RANGES, ranges = [(0.1, 1), (0, 1), (0, 1), (-1, 1)], xp_given_xeff.PARAM_RANGES
+        try:
+            p_xp = xp_given_xeff.get_xp_given_xeff_expression(*p, xeff).tabulate()
+        finally:
+            xp_given_xeff.PARAM_RANGES = ranges
+
+        # every occurrence of a variable is an independent draw
+        rng = np.random.default_rng(1)
+        n = 2 * 10 ** 6
+        draw = lambda k: self.dists[k].rvs(n, random_state=rng)
+        c = xeff * (draw("q") + 1) / draw("a1") - draw("a2") * draw("q") * draw("cos2") / draw("a1")
+        keep = (c >= 0) & (c <= 1)
+        xp_samples = draw("a1")[keep] * np.sqrt(1 - c[keep] ** 2)
+        counts, edges = np.histogram(xp_samples, bins=50, range=(0, 1))
+        width = edges[1] - edges[0]
+        centres = (edges[1:] + edges[:-1]) / 2
+        self.assertLess(np.sum(np.abs(p_xp(centres) - counts / n / width)) * width, 1e-2)
+
+    def test_mellin_chain_matches_batch(self):
+        p = [self.dists[k].pdf for k in ["a1", "a2", "q", "cos2"]]
+        z = np.linspace(0, 1, 401)
+        xp_given_xeff.PARAM_RANGES, ranges = [(0.1, 1), (0, 1), (0, 1), (-1, 1)], xp_given_xeff.PARAM_RANGES
+        try:
+            for xeff in [0.3, -0.5]:
+                expression = xp_given_xeff.get_xp_given_xeff_expression(*p, xeff)
+                batch = expression.tabulate(product_method="batch")(z)
+                mellin = expression.tabulate(product_method="mellin")(z)
+                self.assertLess(np.trapezoid(np.abs(mellin - batch), z), 0.04 * np.trapezoid(batch, z), xeff)
+        finally:
+            xp_given_xeff.PARAM_RANGES = ranges
+
+    def test_xp_given_xeff_at_zero(self):
+        # xeff(q+1) has no density at xeff = 0; the limit xeff -> 0 drops that term of c
+        p = [self.dists[k].pdf for k in ["a1", "a2", "q", "cos2"]]
+        z = np.linspace(0, 1, 201)
+        xp_given_xeff.PARAM_RANGES, ranges = [(0.1, 1), (0, 1), (0, 1), (-1, 1)], xp_given_xeff.PARAM_RANGES
+        try:
+            p_xp = {
+                xeff: xp_given_xeff.get_xp_given_xeff_expression(*p, xeff).tabulate()(z)
+                for xeff in [-1e-4, 0, 1e-4]
+            }
+        finally:
+            xp_given_xeff.PARAM_RANGES = ranges
+        self.assertGreater(np.trapezoid(p_xp[0], z), 0.3)
+        for xeff in [-1e-4, 1e-4]:
+            self.assertLess(np.trapezoid(np.abs(p_xp[xeff] - p_xp[0]), z), 1e-3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+import unittest
+
+import numpy as np
+from scipy.stats import gaussian_kde, multivariate_normal
+
+from effective_spins import density_estimation
+from effective_spins.probability_cacher import XeffIndexedTable
+
+
+class TestDensityEstimation(unittest.TestCase):
+    def setUp(self):
+        self.rng = np.random.default_rng(0)
+
+    def test_bin_samples_matches_histogram(self):
+        x = self.rng.uniform(-1.2, 1.2, 100000)
+        y = self.rng.uniform(-0.1, 1.1, 100000)
+        x[:3] = [-1, 1, 0]
+        y[:3] = [0, 1, 1]
+        counts = density_estimation.bin_samples(x, y, (-1, 1), (0, 1), (40, 20))
+        expected, _, _ = np.histogram2d(x, y, bins=(40, 20), range=[(-1, 1), (0, 1)])
+        np.testing.assert_array_equal(counts, expected)
+
+    def test_binned_kde_matches_gaussian_kde(self):
+        cov = [[0.04, 0.01], [0.01, 0.02]]
+        x, y = self.rng.multivariate_normal([0.1, 0.5], cov, 5000).T
+        xs, ys, p = density_estimation.binned_kde(x, y, (-1, 1), (0, 1), bins=(200, 100), reflect=False)
+        self.assertAlmostEqual(np.sum(p) * (xs[1] - xs[0]) * (ys[1] - ys[0]), 1)
+        grid = np.stack(np.meshgrid(xs, ys, indexing="ij"), axis=-1)
+        kde = gaussian_kde(np.vstack([x, y]))(grid.reshape(-1, 2).T).reshape(p.shape)
+        np.testing.assert_allclose(p, kde, atol=0.03 * kde.max())
+
+        x, y = self.rng.multivariate_normal([0.1, 0.5], cov, 10 ** 7).T
+        _, _, p = density_estimation.binned_kde(
+            x, y, (-1, 1), (0, 1), bins=(200, 100), bandwidth=(0.01, 0.01), reflect=False
+        )
+        truth = multivariate_normal([0.1, 0.5], cov).pdf(grid)
+        truth /= np.sum(truth) * (xs[1] - xs[0]) * (ys[1] - ys[0])
+        np.testing.assert_allclose(p, truth, atol=0.03 * truth.max())
+
+    def test_reflection_at_bounds(self):
+        x = self.rng.uniform(-1, 1, 10 ** 6)
+        y = self.rng.uniform(0, 1, 10 ** 6)
+        _, _, p = density_estimation.binned_kde(x, y, (-1, 1), (0, 1), bins=(100, 50), bandwidth=(0.1, 0.1))
+        np.testing.assert_allclose(p, 0.5, rtol=0.05)
+        _, _, p = density_estimation.binned_kde(
+            x, y, (-1, 1), (0, 1), bins=(100, 50), bandwidth=(0.1, 0.1), reflect=False
+        )
+        self.assertLess(p[0, 0], 0.4)
+
+    def test_density_to_df(self):
+        x, y = self.rng.normal(0, 0.3, (2, 10000))
+        xs, ys, p = density_estimation.binned_kde(x, y, (-1, 1), (0, 1), bins=(20, 10))
+        df = density_estimation.density_to_df(xs, ys, p)
+        table = XeffIndexedTable.from_columns(df, "xp", "p_xp_and_xeff")
+        np.testing.assert_allclose(table.to_grid()[2], p)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,6 +4,8 @@ import unittest
 import matplotlib.pyplot as plt
 import numpy as np
 import pytest
+from scipy.interpolate import interp1d
+from scipy.stats import lognorm, norm
 
 from effective_spins import distribution_rules
 from .utils import uniform_distribution
@@ -44,6 +46,144 @@ class TestDistributionRules(unittest.TestCase):
                                                      pdf_b=self.dist_b.prob)
         self.assertGreater(np.sum(dist_c(self.z_vals)), 1)
 
+    def test_batch_matches_loop(self):
+        a_vals = np.linspace(-2, 2, 500)
+        z_vals = np.linspace(-3, 3, 301)
+        for rule in [distribution_rules.sum_distribution, distribution_rules.product_distribution]:
+            kwargs = dict(z_vals=z_vals, a_vals=a_vals, pdf_a=self.dist_a.prob, pdf_b=self.dist_b.prob)
+            loop = rule(**kwargs, method="loop")
+            batch = rule(**kwargs, method="batch")
+            chunked = rule(**kwargs, method="batch", chunk_size=7)
+            np.testing.assert_allclose(batch, loop, rtol=1e-12, atol=1e-12)
+            np.testing.assert_allclose(chunked, loop, rtol=1e-12, atol=1e-12)
+
+    def test_fft_sum_matches_loop(self):
+        a_vals = np.linspace(-2, 2, 401)
+        z_vals = np.linspace(-3, 3, 601)
+        kwargs = dict(z_vals=z_vals, a_vals=a_vals, pdf_a=norm(0.2, 0.3).pdf, pdf_b=norm(-0.5, 0.4).pdf)
+        loop = distribution_rules.sum_distribution(**kwargs, method="loop")
+        fft = distribution_rules.sum_distribution(**kwargs, method="fft")
+        np.testing.assert_allclose(fft, loop, rtol=1e-6, atol=1e-10)
+        np.testing.assert_allclose(fft, norm(-0.3, 0.5).pdf(z_vals), atol=1e-3)
+
+        # off-grid z and discontinuous pdfs are interpolated
+        z_vals = np.linspace(-3, 3, 257)
+        kwargs = dict(z_vals=z_vals, a_vals=a_vals, pdf_a=self.dist_a.prob, pdf_b=self.dist_b.prob)
+        loop = distribution_rules.sum_distribution(**kwargs, method="loop")
+        auto = distribution_rules.sum_distribution(**kwargs)
+        np.testing.assert_allclose(auto, loop, atol=1e-2)
+
+        # a grid with two spacings, or too few points, falls back to the batch rule
+        a_vals = np.concatenate([np.linspace(-2, 0, 101), np.linspace(0, 2, 401)[1:]])
+        z_vals = np.linspace(-3, 3, 601)
+        for grid in [a_vals, a_vals[:1]]:
+            kwargs = dict(z_vals=z_vals, a_vals=grid, pdf_a=norm(0.2, 0.3).pdf, pdf_b=norm(-0.5, 0.4).pdf)
+            self.assertIsNone(distribution_rules.fft_sum_distribution(**kwargs))
+            np.testing.assert_array_equal(
+                distribution_rules.sum_distribution(**kwargs, method="fft"),
+                distribution_rules.sum_distribution(**kwargs, method="batch"),
+            )
+
+    def test_mellin_product_matches_loop(self):
+        # lognormal * lognormal is lognormal
+        a_vals = np.linspace(0.01, 5, 800)
+        z_vals = np.linspace(0.05, 4, 200)
+        pdf_c = distribution_rules.product_distribution(
+            z_vals=z_vals, a_vals=a_vals, pdf_a=lognorm(0.3).pdf, pdf_b=lognorm(0.4).pdf, method="mellin"
+        )
+        np.testing.assert_allclose(pdf_c, lognorm(0.5).pdf(z_vals), atol=1e-4)
+
+        # mixed sign b
+        a_vals = np.linspace(0.2, 2, 400)
+        z_vals = np.linspace(-2, 2, 160)
+        kwargs = dict(z_vals=z_vals, a_vals=a_vals, pdf_a=norm(1, 0.2).pdf, pdf_b=norm(0.1, 0.5).pdf)
+        loop = distribution_rules.product_distribution(**kwargs, method="loop")
+        mellin = distribution_rules.product_distribution(**kwargs, method="mellin")
+        np.testing.assert_allclose(mellin, loop, atol=1e-4)
+
+    def test_adaptive_grid(self):
+        fine = np.linspace(-10, 10, 200001)
+        pdfs = dict(
+            peaked=norm(0.3, 0.05).pdf,
+            inverse=lambda z: distribution_rules.inverse_distribution(z_vals=z, pdf_a=self.dist_b.prob),
+        )
+        for name, pdf in pdfs.items():
+            truth = pdf(fine)
+            mass = np.trapezoid(truth, fine)
+            z, p = distribution_rules.adaptive_grid(pdf, -10, 10, tolerance=1e-3)
+            self.assertTrue(np.all(np.diff(z) > 0))
+            np.testing.assert_array_equal(p, pdf(z))
+            error = np.trapezoid(np.abs(np.interp(fine, z, p, left=0, right=0) - truth), fine) / mass
+            self.assertLess(error, 2e-3, name)
+            z_uniform = np.linspace(-10, 10, len(z))
+            error_uniform = np.trapezoid(np.abs(np.interp(fine, z_uniform, pdf(z_uniform)) - truth), fine) / mass
+            self.assertLess(error, error_uniform / 10, name)
+
+        # the support is found and bracketed by zeros
+        z, p = distribution_rules.adaptive_grid(self.dist_b.prob, -10, 10)
+        self.assertTrue(-0.25 < z[0] <= 0 and 1 <= z[-1] < 1.25)
+        self.assertEqual(p[0], 0)
+        self.assertEqual(p[-1], 0)
+
+    def test_tabulated_density(self):
+        z = np.concatenate([np.linspace(-3, 3, 5001), [np.nan, np.inf, -np.inf]])
+        for x in [np.linspace(-2, 2, 201), np.sort(np.random.uniform(-2, 2, 201))]:
+            p = norm.pdf(x)
+            density = distribution_rules.TabulatedDensity(x, p)
+            self.assertEqual(density.uniform, x[1] - x[0] == x[2] - x[1])
+            expected = interp1d(x, p, fill_value=0, bounds_error=False)(z)
+            np.testing.assert_allclose(density(z[:-3]), expected[:-3], atol=1e-12)
+            np.testing.assert_array_equal(density(z[-3:]), 0)
+            self.assertEqual(density(x[::7]).shape, x[::7].shape)
+            self.assertEqual(density(np.ones((3, 4))).shape, (3, 4))
+
+        # rules use the tabulated values directly on the density's own grid
+        a_vals = np.linspace(-2, 2, 401)
+        z_vals = np.linspace(-3, 3, 101)
+        pdf_a = distribution_rules.TabulatedDensity(a_vals, norm(0.2, 0.3).pdf(a_vals))
+        np.testing.assert_array_equal(distribution_rules.evaluate_pdf(pdf_a, a_vals), pdf_a.p)
+        for rule in [distribution_rules.sum_distribution, distribution_rules.product_distribution]:
+            tabulated = rule(z_vals=z_vals, a_vals=a_vals, pdf_a=pdf_a, pdf_b=norm(-0.5, 0.4).pdf)
+            direct = rule(z_vals=z_vals, a_vals=a_vals, pdf_a=norm(0.2, 0.3).pdf, pdf_b=norm(-0.5, 0.4).pdf)
+            np.testing.assert_allclose(tabulated, direct, atol=1e-12)
+
+    def test_batched_densities(self):
+        # rows of a batched density go through the rules like separate densities
+        a_vals = np.linspace(-2, 2, 401)
+        z_vals = np.linspace(-3, 3, 101)
+        locs = np.array([-0.3, 0.0, 0.4])
+        p = norm.pdf(a_vals[None, :], loc=locs[:, None], scale=0.3)
+        for x in [a_vals, np.sort(np.random.uniform(-2, 2, 401))]:
+            batched = distribution_rules.TabulatedDensity(x, norm.pdf(x[None, :], loc=locs[:, None], scale=0.3))
+            self.assertEqual(batched(z_vals).shape, (len(locs), len(z_vals)))
+            for row, p_row in zip(batched(z_vals), batched.p):
+                np.testing.assert_allclose(row, distribution_rules.TabulatedDensity(x, p_row)(z_vals), atol=1e-12)
+
+        pdf_a = distribution_rules.TabulatedDensity(a_vals, p)
+        rules = dict(
+            sum=lambda pdf: distribution_rules.sum_distribution(z_vals, a_vals, pdf, norm(-0.5, 0.4).pdf),
+            fft=lambda pdf: distribution_rules.fft_sum_distribution(z_vals, a_vals, pdf, norm(-0.5, 0.4).pdf),
+            product=lambda pdf: distribution_rules.product_distribution(z_vals, a_vals, pdf, norm(-0.5, 0.4).pdf),
+            mellin=lambda pdf: distribution_rules.product_distribution(
+                z_vals, a_vals, pdf, norm(-0.5, 0.4).pdf, method="mellin"
+            ),
+            inverse=lambda pdf: distribution_rules.inverse_distribution(z_vals, pdf),
+        )
+        for name, rule in rules.items():
+            batched = rule(pdf_a)
+            self.assertEqual(batched.shape, (len(locs), len(z_vals)), name)
+            for row, p_row in zip(batched, p):
+                separate = rule(distribution_rules.TabulatedDensity(a_vals, p_row))
+                np.testing.assert_allclose(row, separate, atol=1e-12, err_msg=name)
+
+        # one adaptive grid resolves every row
+        z, p_z = distribution_rules.adaptive_grid(pdf_a, -2, 2, tolerance=1e-3)
+        self.assertEqual(p_z.shape, (len(locs), len(z)))
+        fine = np.linspace(-2, 2, 20001)
+        for row, p_row in zip(p_z, pdf_a(fine)):
+            error = np.trapezoid(np.abs(np.interp(fine, z, row) - p_row), fine)
+            self.assertLess(error, 2e-3)
+
     def test_translate_rule(self):
         s = 2
         t = 1
@@ -0,0 +1,53 @@
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+from effective_spins import probability_cacher
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULES = [
+    "effective_spins.conversions",
+    "effective_spins.cupy_utils",
+    "effective_spins.density_algebra",
+    "effective_spins.density_estimation",
+    "effective_spins.distribution_rules",
+    "effective_spins.joint_xp_xeff_prior",
+    "effective_spins.numba_kernels",
+    "effective_spins.priors_conditional_on_xeff",
+    "effective_spins.probability_cacher",
+    "effective_spins.xp_given_xeff",
+]
+DEFERRED = ["bilby", "cupy", "jax", "matplotlib", "numba", "numexpr", "pandas", "scipy", "tqdm"]
+
+
+def import_in_subprocess(modules):
+    """(deferred packages that were imported, active backends) after importing `modules` in a fresh interpreter."""
+    code = (
+        "import importlib, json, sys\n"
+        f"for m in {modules!r}:\n"
+        "    importlib.import_module(m)\n"
+        "from effective_spins import cupy_utils\n"
+        f"loaded = [m for m in {DEFERRED!r} if m in sys.modules]\n"
+        "backends = [backend.name for backend in cupy_utils._ACTIVE_BACKEND]\n"
+        "print(json.dumps(dict(loaded=loaded, backends=backends)))\n"
+    )
+    result = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True)
+    out = json.loads(result.stdout.splitlines()[-1])
+    return out["loaded"], out["backends"]
+
+
+class TestImports(unittest.TestCase):
+    def test_core_imports_are_light(self):
+        loaded, backends = import_in_subprocess(MODULES)
+        self.assertEqual(loaded, [])
+        self.assertEqual(backends, [])
+
+    def test_style_is_local(self):
+        self.assertTrue(os.path.isfile(probability_cacher.STYLE_FILE))
+        plt = probability_cacher.get_pyplot()
+        self.assertEqual(plt.rcParams["xtick.direction"], "in")
+        # applied once: later changes are not reset
+        with plt.rc_context({"xtick.direction": "out"}):
+            self.assertEqual(probability_cacher.get_pyplot().rcParams["xtick.direction"], "out")
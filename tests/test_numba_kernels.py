@@ -0,0 +1,56 @@
+import unittest
+
+import numpy as np
+import pytest
+from scipy.stats import norm
+
+from effective_spins import conversions, distribution_rules, numba_kernels
+from effective_spins.cupy_utils import xp
+from . import utils
+
+
+@pytest.mark.skipif(not numba_kernels.NUMBA_LOADED, reason="numba not installed")
+class TestNumbaKernels(unittest.TestCase):
+    def setUp(self):
+        self.s = utils.get_traditional_prior().sample(50000)
+        self.s = {k: np.asarray(v) for k, v in self.s.items()}
+        self.s["sin1"] = np.sqrt(1 - self.s["cos1"] ** 2)
+        self.s["sin2"] = np.sqrt(1 - self.s["cos2"] ** 2)
+        self.s["tan1"] = self.s["sin1"] / self.s["cos1"]
+        self.s["tan2"] = self.s["sin2"] / self.s["cos2"]
+        self.s["a1"][:5] = np.nan
+
+    def tearDown(self):
+        numba_kernels.USE_NUMBA = True
+
+    def compare(self, func, **kwargs):
+        jit = func(**kwargs)
+        numba_kernels.USE_NUMBA = False
+        ref = func(**kwargs)
+        numba_kernels.USE_NUMBA = True
+        self.assertIsInstance(jit, np.ndarray)
+        np.testing.assert_allclose(jit, ref, rtol=1e-14)
+
+    def test_conversions_match_xp(self):
+        s = self.s
+        self.compare(conversions.q_factor, q=s["q"])
+        self.compare(conversions.calculate_xeff, a1=s["a1"], a2=s["a2"], cos1=s["cos1"], cos2=s["cos2"], q=s["q"])
+        self.compare(conversions.calculate_xp, a1=s["a1"], a2=s["a2"], q=s["q"], sin1=s["sin1"], sin2=s["sin2"])
+        self.compare(
+            conversions.calculate_xp_given_xeff, xeff=0.3, a1=s["a1"], a2=s["a2"], q=s["q"],
+            cos1=s["cos1"], cos2=s["cos2"], tan1=s["tan1"], tan2=s["tan2"]
+        )
+        # scalars, 2-D arrays and pandas objects keep the xp path
+        self.assertEqual(conversions.q_factor(0.5), ((3.0 + 4.0 * 0.5) / (4.0 + 3.0 * 0.5)) * 0.5)
+        self.assertEqual(conversions.q_factor(np.ones((300, 300))).shape, (300, 300))
+
+    def test_batch_integrate_matches_xp(self):
+        a_vals = np.linspace(-2, 2, 500)
+        z_vals = np.linspace(-3, 3, 301)
+        kwargs = dict(z_vals=z_vals, a_vals=a_vals, pdf_a=norm(0.2, 0.3).pdf, pdf_b=norm(-0.5, 0.4).pdf)
+        for rule in [distribution_rules.sum_distribution, distribution_rules.product_distribution]:
+            self.compare(rule, method="batch", **kwargs)
+
+
+if __name__ == "__main__":
+    unittest.main()
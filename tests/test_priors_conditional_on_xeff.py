@@ -1,13 +1,16 @@
 import os
 import unittest
+from unittest import mock
 
 import matplotlib.pyplot as plt
 import numpy as np
 import pytest
+from scipy.stats import uniform
 from tqdm.auto import tqdm
 
-from effective_spins import priors_conditional_on_xeff
+from effective_spins import cupy_utils, priors_conditional_on_xeff
 from effective_spins.conversions import calculate_xeff
+from effective_spins.cupy_utils import uniform_pdf
 from . import utils
 
 CLEAN = False
@@ -84,6 +87,126 @@ class TestPriorConditionalOnXeff(unittest.TestCase):
         )
         self.assertNotEqual(p_a1, 1)
 
+    def test_p_param_and_xeff_grid(self):
+        params = np.linspace(0.05, 0.95, 7)
+        xeffs = np.array([-0.5, 0.0, 0.3])
+        samples = self.p.sample(20000)
+        grid = priors_conditional_on_xeff.p_param_and_xeff_grid(
+            params, xeffs, self.p, "a1", samples=samples
+        )
+        self.assertEqual(grid.shape, (len(params), len(xeffs)))
+        for j, xeff in enumerate(xeffs):
+            column = priors_conditional_on_xeff.p_param_and_xeff_grid(
+                params, [xeff], self.p, "a1", samples=samples
+            )
+            np.testing.assert_allclose(column[:, 0], grid[:, j])
+        p_val = priors_conditional_on_xeff.p_param_and_xeff(
+            param=params[3], xeff=xeffs[1], init_a1a2qcos2_prior=self.p, param_key="a1"
+        )
+        self.assertAlmostEqual(p_val, grid[3, 1], delta=0.05 * p_val)
+
+    def test_grid_blocks_fit_memory_budget(self):
+        params = np.linspace(0.05, 0.95, 5)
+        xeffs = np.linspace(-0.9, 0.9, 50)
+        samples = self.p.sample(1000)
+        full = priors_conditional_on_xeff.p_param_and_xeff_grid(params, xeffs, self.p, "q", samples=samples)
+        budget = priors_conditional_on_xeff.MEMORY_BUDGET
+        block_sizes = []
+
+        def recording_uniform_pdf(x, loc, scale):
+            block_sizes.append(np.broadcast(x, loc, scale).size)
+            return uniform_pdf(x, loc, scale)
+
+        # 8 bytes * 1000 samples * 50 xeffs is over the budget even for one param
+        priors_conditional_on_xeff.MEMORY_BUDGET = 8 * 1000 * 20
+        try:
+            with mock.patch.object(priors_conditional_on_xeff, "uniform_pdf", recording_uniform_pdf):
+                chunked = priors_conditional_on_xeff.p_param_and_xeff_grid(
+                    params, xeffs, self.p, "q", samples=samples
+                )
+        finally:
+            priors_conditional_on_xeff.MEMORY_BUDGET = budget
+        self.assertLessEqual(8 * max(block_sizes), 8 * 1000 * 20)
+        np.testing.assert_allclose(chunked, full, rtol=1e-12)
+
+    def test_analytic_matches_mc(self):
+        xeffs = np.array([-0.6, -0.1, 0.2, 0.5, 0.9])
+        # seeded quasi-random reference (np.random.seed does not reach bilby's sampler)
+        samples = priors_conditional_on_xeff.draw_samples(self.p, 2 ** 18, sampler="sobol", seed=0)
+        param_ranges = dict(a1=(0.05, 0.95), a2=(0.05, 0.95), q=(0.05, 0.95), cos2=(-0.9, 0.9))
+        for param_key, (low, high) in param_ranges.items():
+            params = np.linspace(low, high, 6)
+            analytic = priors_conditional_on_xeff.p_param_and_xeff_grid(
+                params, xeffs, self.p, param_key, method="analytic"
+            )
+            mc = priors_conditional_on_xeff.p_param_and_xeff_grid(
+                params, xeffs, self.p, param_key, samples=samples
+            )
+            np.testing.assert_allclose(analytic, mc, atol=0.02 * mc.max(), err_msg=param_key)
+
+        p_xeff = priors_conditional_on_xeff.p_xeff(np.array([-1.0, 0.0, 1.0]), self.p, method="analytic")
+        self.assertAlmostEqual(p_xeff[0], 0, places=10)
+        self.assertAlmostEqual(p_xeff[2], 0, places=10)
+        self.assertGreater(p_xeff[1], 1.9)
+        self.assertLess(p_xeff[1], 3)
+
+    def test_qmc_standard_error(self):
+        params = np.linspace(0.1, 0.9, 5)
+        xeffs = np.array([-0.3, 0.2])
+        analytic = priors_conditional_on_xeff.p_param_and_xeff_grid(
+            params, xeffs, self.p, "q", method="analytic"
+        )
+        p, p_err = priors_conditional_on_xeff.p_param_and_xeff_qmc(
+            params, xeffs, self.p, "q", num_samples=2 ** 10, tolerance=5e-3, seed=1
+        )
+        self.assertLessEqual(p_err.max(), 5e-3)
+        self.assertTrue(np.all(np.abs(p - analytic) < 5 * p_err + 1e-3))
+
+        samples = priors_conditional_on_xeff.draw_samples(self.p, 2 ** 14, sampler="halton", seed=1)
+        p, p_err = priors_conditional_on_xeff.p_param_and_xeff_grid(
+            params, xeffs, self.p, "q", samples=samples, return_error=True
+        )
+        self.assertTrue(np.all(p_err > 0))
+        self.assertTrue(np.all(np.abs(p - analytic) < 5 * p_err + 1e-3))
+
+    def test_sample_bank(self):
+        bank = priors_conditional_on_xeff.get_sample_bank(self.p, 10000, seed=3)
+        self.assertIs(bank, priors_conditional_on_xeff.get_sample_bank(self.p, 10000, seed=3))
+        self.assertIsNot(bank, priors_conditional_on_xeff.get_sample_bank(self.p, 10000, seed=4))
+        self.assertEqual(set(bank.keys()), set(self.p.keys()))
+
+        # one bank per backend, at most SAMPLE_BANK_SIZE of them, and clear_sample_bank empties it
+        backend = cupy_utils.get_backend().name
+        try:
+            cupy_utils.set_backend("numexpr")
+            self.assertIsNot(bank, priors_conditional_on_xeff.get_sample_bank(self.p, 10000, seed=3))
+        finally:
+            cupy_utils.set_backend(backend)
+        for seed in range(priors_conditional_on_xeff.SAMPLE_BANK_SIZE + 2):
+            priors_conditional_on_xeff.get_sample_bank(self.p, 100, seed=seed)
+        self.assertEqual(len(priors_conditional_on_xeff.SAMPLE_BANK), priors_conditional_on_xeff.SAMPLE_BANK_SIZE)
+        priors_conditional_on_xeff.clear_sample_bank()
+        self.assertEqual(priors_conditional_on_xeff.SAMPLE_BANK, {})
+
+        params = np.linspace(0.1, 0.9, 5)
+        grid = priors_conditional_on_xeff.p_param_and_xeff_grid(params, [0.2], self.p, "a2", samples=bank)
+        for param, p_grid in zip(params, grid[:, 0]):
+            p_val = priors_conditional_on_xeff.p_param_and_xeff(
+                param=param, xeff=0.2, init_a1a2qcos2_prior=self.p, param_key="a2", samples=bank
+            )
+            self.assertAlmostEqual(p_val, p_grid)
+        self.assertEqual(
+            priors_conditional_on_xeff.p_param_given_xeff(0.5, 0.2, self.p, "a2", samples=bank),
+            priors_conditional_on_xeff.p_param_given_xeff(0.5, 0.2, self.p, "a2", samples=bank),
+        )
+
+    def test_uniform_pdf(self):
+        x = np.random.uniform(-2, 2, 1000)
+        loc = np.random.uniform(-1, 1, 1000)
+        scale = np.random.uniform(-0.5, 2, 1000)
+        scale[:10] = 0
+        np.testing.assert_array_equal(uniform_pdf(x, loc, scale), uniform.pdf(x, loc=loc, scale=scale))
+
     def test_p_q_and_xeff(self):
         fig, axes = plt.subplots(nrows=2, ncols=1, sharex=True)
 
@@ -1,7 +1,10 @@
 import os
 import unittest
 
+import numpy as np
+import pandas as pd
 import pytest
+from effective_spins.computers import compute_and_store_prior_xeff
 from effective_spins.priors_conditional_on_xeff import p_xeff
 
 from . import utils
@@ -27,6 +30,19 @@ class TestXeffPrior(unittest.TestCase):
         self.assertGreater(p_xeff_val, 1.9)
         self.assertLess(p_xeff_val, 3)
 
+    def test_parallel_p_xeff_table(self):
+        a1s, xeffs = np.linspace(0, 1, 20), np.linspace(-1, 1, 9)
+        df = pd.DataFrame(dict(
+            xeff=np.repeat(xeffs, len(a1s)),
+            a1=np.tile(a1s, len(xeffs)),
+            p_a1_and_xeff=np.repeat(1 - xeffs ** 2, len(a1s)),
+        )).sample(frac=1, random_state=0)
+        serial = compute_and_store_prior_xeff.compute_p_xeff_table(df)
+        parallel = compute_and_store_prior_xeff.compute_p_xeff_table(df, n_workers=3)
+        pd.testing.assert_frame_equal(serial, parallel)
+        np.testing.assert_allclose(parallel.xeff, xeffs)
+        np.testing.assert_allclose(parallel.p_xeff, 1 - xeffs ** 2)
+
     @pytest.mark.plot
     def test_plot_xeff_samples_and_p_xeff(self):
         samples = utils.get_traditional_samples()
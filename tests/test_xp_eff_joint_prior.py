@@ -2,6 +2,8 @@ import os
 import shutil
 import unittest
 
+import numpy as np
+
 from effective_spins import joint_xp_xeff_prior
 
 
@@ -19,6 +21,29 @@ class TestXpXeffJointPrior(unittest.TestCase):
         val = joint_xp_xeff_prior.p_xp_xeff(xp=0.1, xeff=1)
         self.assertNotEqual(1, val)
 
+    def test_joint_prior(self):
+        prior = joint_xp_xeff_prior.JointXpXeffPrior.from_prior(num_samples=10 ** 6, bins=(100, 50), seed=1)
+        dxeff, dxp = prior.xeffs[1] - prior.xeffs[0], prior.xps[1] - prior.xps[0]
+        self.assertAlmostEqual(prior.probs.sum() * dxeff * dxp, 1)
+
+        # exact at bin centres, bilinear in between, zero outside the support
+        np.testing.assert_allclose(prior.prob(prior.xeffs[:, None], prior.xps[None, :]), prior.probs, atol=1e-12)
+        mid = prior.prob(prior.xeffs[10] + dxeff / 2, prior.xps[5])
+        self.assertAlmostEqual(mid, prior.probs[10:12, 5].mean())
+        self.assertEqual(prior.prob(0.1, 1.5), 0)
+        self.assertEqual(prior.ln_prob(-1.5, 0.5), -np.inf)
+
+        samples = prior.sample(20000, seed=2)
+        self.assertEqual(samples["xeff"].shape, (20000,))
+        self.assertTrue(np.all(np.abs(samples["xeff"]) <= 1))
+        self.assertTrue(np.all((samples["xp"] >= 0) & (samples["xp"] <= 1)))
+        # the density matches an independent draw
+        counts, _, _ = np.histogram2d(
+            samples["xeff"], samples["xp"], bins=(10, 5), range=[(-1, 1), (0, 1)], density=True
+        )
+        coarse = prior.probs.reshape(10, 10, 5, 10).mean(axis=(1, 3))
+        np.testing.assert_allclose(counts, coarse, atol=0.1 * coarse.max())
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -3,6 +3,7 @@ import unittest
 
 import matplotlib.pyplot as plt
 import numpy as np
+from scipy.stats import beta, uniform
 
 from effective_spins import xp_given_xeff
 from . import utils
@@ -194,6 +195,47 @@ class TestXpGivenXeffPrior(unittest.TestCase):
         plt.close()
 
 
+class TestAdaptiveGrids(unittest.TestCase):
+    def tearDown(self):
+        xp_given_xeff.TOLERANCE = None
+
+    def test_adaptive_chain_matches_uniform(self):
+        p_params = (beta(2, 2).pdf, uniform(0, 1).pdf, beta(3, 1.5).pdf, uniform(-1, 2).pdf)
+        d_vals = np.linspace(0.02, 0.98, 200)
+        p_d = {}
+        for tolerance in [None, 3e-3]:
+            xp_given_xeff.TOLERANCE = tolerance
+            a1, a2, q, cos2 = xp_given_xeff.get_param_grid(p_params)
+            d, p_d[tolerance] = xp_given_xeff.get_p_d_and_vals(a2, *p_params, xeff=0.3)
+            p_d[tolerance] = p_d[tolerance](d_vals)
+        self.assertLess(len(d), xp_given_xeff.N)
+        uniform_grid, adaptive = p_d[None], p_d[3e-3]
+        self.assertLess(np.trapezoid(np.abs(adaptive - uniform_grid), d_vals), 0.05 * np.trapezoid(uniform_grid, d_vals))
+
+
+class TestBatchedXpGivenXeff(unittest.TestCase):
+    def test_grid_matches_single_xeff(self):
+        p_param_given_xeff = dict(
+            a1=lambda xeff, a1: beta.pdf(a1, 2 + xeff, 2),
+            a2=lambda xeff, a2: uniform.pdf(a2) + 0 * xeff,
+            q=lambda xeff, q: beta.pdf(q, 3 + 0.5 * xeff, 1.5),
+            cos2=lambda xeff, cos2: uniform.pdf(cos2, -1, 2) * (1 + 0.8 * xeff * cos2),
+        )
+        # includes xeff = 0, as in an odd np.linspace(-1, 1, n)
+        xeffs = np.array([-0.6, 0.0, 0.1, 0.7, 0.0])
+        xps, probs = xp_given_xeff.get_p_xp_given_xeff_grid(xeffs, p_param_given_xeff)
+        self.assertEqual(probs.shape, (len(xeffs), len(xps)))
+        for xeff, p_xp in zip(xeffs, probs):
+            p_params = [lambda x, f=p_param_given_xeff[k]: f(xeff, x) for k in xp_given_xeff.PARAMS]
+            single = xp_given_xeff.get_xp_given_xeff_expression(*p_params, xeff).tabulate(
+                xp_given_xeff.N, product_method=xp_given_xeff.PRODUCT_METHOD
+            )(xps)
+            self.assertLess(np.trapezoid(np.abs(p_xp - single), xps), 0.01 * np.trapezoid(single, xps))
+
+        xps_zero, probs_zero = xp_given_xeff.get_p_xp_given_xeff_grid([0.0], p_param_given_xeff)
+        np.testing.assert_allclose(np.interp(xps, xps_zero, probs_zero[0]), probs[1])
+
+
 def get_functions(xeff):
     a1, a2, q, cos2 = xp_given_xeff.get_param_grid()
     p_a1, p_a2, p_q, p_cos2 = xp_given_xeff.get_p_param_given_xeff(xeff)
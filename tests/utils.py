@@ -2,7 +2,6 @@ import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 from bilby.core.prior import Uniform
-from bilby.core.prior import PriorDict
 from scipy.ndimage import gaussian_filter
 from scipy.stats import gaussian_kde
 
@@ -11,16 +10,7 @@ from effective_spins.conversions import (
     calculate_xp,
     calculate_xp_given_xeff,
 )
-
-
-def get_traditional_prior():
-    priors = PriorDict()
-    priors["q"] = Uniform(minimum=0, maximum=1)
-    priors["a1"] = Uniform(minimum=0, maximum=1)
-    priors["a2"] = Uniform(minimum=0, maximum=1)
-    priors["cos2"] = Uniform(minimum=-1, maximum=1)
-    priors["cos1"] = Uniform(minimum=-1, maximum=1)
-    return priors
+from effective_spins.priors_conditional_on_xeff import get_traditional_prior
 
 
 def uniform_distribution(min=-1, max=1, N=10000):